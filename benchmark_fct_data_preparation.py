@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+-------------------------------------------------------------------------------
+"This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+
+Benchmark the data preparation tools on synthetic datasets of several sizes:
+regular grid raster tiles, a multipart mask and a dendritic hydrological
+network with BD TOPO like attributes. The timings are written as JSON, with
+a scaling exponent (slope of the log-log duration curve) for each tool.
+"""
+
+import os
+import math
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import datetime
+import fiona
+import fiona.crs
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping, MultiPolygon
+import fct.report
+import fct.raster_tools
+import fct.vector_tools
+import fct.network_graph
+
+CRS = '2154'
+# tiles are TILE_PIXELS x TILE_PIXELS pixels of TILE_SIZE / TILE_PIXELS meters
+TILE_SIZE = 1000
+TILE_PIXELS = 10
+ORIGIN = (900000, 6500000)
+
+def generate_tiles(tiles_dir, count, extension='.asc'):
+    """
+    Write `count` tiles on a regular grid, named like the RGE ALTI tiles.
+    """
+    os.makedirs(tiles_dir, exist_ok=True)
+    columns = int(math.ceil(math.sqrt(count)))
+    res = TILE_SIZE / TILE_PIXELS
+
+    for i in range(count):
+        minx = ORIGIN[0] + (i % columns) * TILE_SIZE
+        maxy = ORIGIN[1] + (i // columns + 1) * TILE_SIZE
+        name = 'RGEALTI_FXX_{:04d}_{:04d}_MNT_LAMB93_IGN69{}'.format(minx // 1000, maxy // 1000, extension)
+        values = np.full((TILE_PIXELS, TILE_PIXELS), i % 1000, dtype='float32')
+
+        if extension == '.asc':
+            with open(os.path.join(tiles_dir, name), 'w') as f:
+                f.write('ncols {0}\nnrows {0}\nxllcorner {1}\nyllcorner {2}\ncellsize {3}\nNODATA_value -99999\n'.format(
+                    TILE_PIXELS, minx, maxy - TILE_SIZE, res))
+                np.savetxt(f, values, fmt='%.1f')
+        else:
+            profile = dict(
+                driver='GTiff', width=TILE_PIXELS, height=TILE_PIXELS, count=1, dtype='float32',
+                crs='EPSG:' + CRS, transform=from_origin(minx, maxy, res, res), nodata=-99999)
+            with rasterio.open(os.path.join(tiles_dir, name), 'w', **profile) as dst:
+                dst.write(values, 1)
+
+    return columns
+
+def generate_mask(mask_path, columns, parts):
+    """
+    Write a mask feature with `parts` squares spread over the tiles grid, covering about half of the tiles.
+    """
+    random.seed(0)
+    extent = columns * TILE_SIZE
+    side = extent / math.sqrt(2 * parts)
+    polygons = []
+
+    for _ in range(parts):
+        x = ORIGIN[0] + random.random() * (extent - side)
+        y = ORIGIN[1] + random.random() * (extent - side)
+        polygons.append(box(x, y, x + side, y + side))
+
+    schema = {'geometry': 'MultiPolygon', 'properties': {'ID': 'int'}}
+    with fiona.open(mask_path, 'w', driver='GPKG', crs=fiona.crs.CRS.from_epsg(int(CRS)), schema=schema) as dst:
+        dst.write({'geometry': mapping(MultiPolygon(polygons)), 'properties': {'ID': 1}})
+
+def generate_network(network_path, count, strahler=False):
+    """
+    Write a dendritic network of `count` reaches flowing to a single outlet,
+    with BD TOPO like attributes, and the STRAHLER order if `strahler`.
+    """
+    random.seed(0)
+    # each node gets a position upstream of its downstream node
+    nodes = [(ORIGIN[0], ORIGIN[1])]
+    lines = []
+    frontier = [0]
+
+    while len(lines) < count:
+        downstream = frontier.pop(random.randrange(len(frontier))) if len(frontier) > 1 else frontier.pop()
+        for _ in range(2 if len(lines) + 2 <= count else 1):
+            x, y = nodes[downstream]
+            nodes.append((x + random.uniform(-500, 500), y + random.uniform(100, 500)))
+            lines.append((len(nodes) - 1, downstream))
+            frontier.append(len(nodes) - 1)
+
+    orders = fct.vector_tools.compute_strahler_orders([(nodes[a], nodes[b]) for a, b in lines])
+
+    schema = {
+        'geometry': 'LineString',
+        'properties': {
+            'cleabs': 'str',
+            'code_du_cours_d_eau_bdcarthage': 'str',
+            'liens_vers_cours_d_eau': 'str',
+            'cpx_toponyme_de_cours_d_eau': 'str',
+            'date_creation': 'str',
+            'date_modification': 'str',
+            'date_d_apparition': 'str',
+            'date_de_confirmation': 'str'
+        }
+    }
+
+    if strahler:
+        schema['properties']['STRAHLER'] = 'int'
+
+    with fiona.open(network_path, 'w', driver='GPKG', crs=fiona.crs.CRS.from_epsg(int(CRS)), schema=schema) as dst:
+        dst.writerecords(
+            {
+                'geometry': {'type': 'LineString', 'coordinates': [nodes[a], nodes[b]]},
+                'properties': {
+                    'cleabs': 'TRONEAU_{:010d}'.format(i),
+                    'code_du_cours_d_eau_bdcarthage': 'V{:07d}'.format(i % 5000),
+                    'liens_vers_cours_d_eau': 'COURDEAU{:010d}'.format(i % 5000),
+                    'cpx_toponyme_de_cours_d_eau': 'Ruisseau {}'.format(i % 5000),
+                    'date_creation': '2006-01-01 00:00:00',
+                    'date_modification': '2020-01-01 00:00:00',
+                    'date_d_apparition': None,
+                    'date_de_confirmation': None,
+                    **({'STRAHLER': order} if strahler else {})
+                }
+            }
+            for i, ((a, b), order) in enumerate(zip(lines, orders))
+        )
+
+def scaling_exponent(sizes, durations):
+    """
+    Slope of the log-log duration curve: 1 for a linear tool, 2 for a quadratic one.
+    """
+    points = [(math.log(size), math.log(duration)) for size, duration in zip(sizes, durations) if duration > 0]
+
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance if variance > 0 else None
+
+def run_benchmark(size, workdir, extension='.asc', workers=4):
+    """
+    Generate the datasets of a size and time every tool, return the measure records by tool.
+    """
+    tiles_dir = os.path.join(workdir, 'tiles')
+    staged_dir = os.path.join(workdir, 'staged')
+    tileset = os.path.join(workdir, 'tileset.gpkg')
+    mask = os.path.join(workdir, 'mask.gpkg')
+    tileset_mask = os.path.join(workdir, 'tileset_mask.gpkg')
+    network = os.path.join(workdir, 'network.gpkg')
+    network_strahler = os.path.join(workdir, 'network_strahler.gpkg')
+
+    columns = generate_tiles(tiles_dir, size, extension)
+    generate_mask(mask, columns, max(1, size // 100))
+    generate_network(network, size)
+    generate_network(network_strahler, size, strahler=True)
+
+    calls = [
+        (fct.raster_tools.CreateTilesetFromRasters, dict(
+            input_dir_path=tiles_dir, extension=extension, tileset_path=tileset, crs=CRS,
+            workers=workers, update=False)),
+        (fct.vector_tools.ExtractBylocation, dict(
+            input_file=tileset, mask_file=mask, output_file=tileset_mask, method='intersects')),
+        (fct.raster_tools.ExtractRasterTilesFromTileset, dict(
+            tileset_path=tileset_mask, raster_dir=tiles_dir, dest_dir=staged_dir, mode='copy', workers=workers)),
+        (fct.vector_tools.StrahlerOrder, dict(
+            hydro_network=network, output_network=os.path.join(workdir, 'strahler.gpkg'))),
+        (fct.vector_tools.IdentifyNetworkNodes, dict(
+            network=network, network_nodes=os.path.join(workdir, 'nodes.gpkg'),
+            network_identified=os.path.join(workdir, 'identified.gpkg'), crs=int(CRS))),
+        (fct.vector_tools.prepare_network_attribut, dict(
+            network_file=network, output_file=os.path.join(workdir, 'network_prepared.gpkg'), crs=CRS)),
+        (fct.network_graph.NetworkMetrics, dict(
+            network=network, output_network=os.path.join(workdir, 'network_metrics.gpkg'))),
+        (fct.vector_tools.CreateSources, dict(
+            hydro_network=network_strahler, output_sources=os.path.join(workdir, 'sources.gpkg'))),
+    ]
+
+    results = dict()
+
+    for func, kwargs in calls:
+        fct.report.reset()
+        func(**kwargs)
+        records = [record for record in fct.report.records if record['name'] == func.__name__]
+        if not records:
+            raise RuntimeError('No measure recorded for %s' % func.__name__)
+        results[func.__name__] = records[-1]
+
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the data preparation tools on synthetic datasets.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help='number of tiles and reaches')
+    parser.add_argument('--extension', choices=['.asc', '.tif'], default='.asc', help='tiles format')
+    parser.add_argument('--workers', type=int, default=4, help='number of threads of the tools')
+    parser.add_argument('--workdir', help='folder of the synthetic datasets, a temporary folder removed at the end by default')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fct_benchmark_')
+    results = dict()
+
+    try:
+        for size in sorted(args.sizes):
+            size_dir = os.path.join(workdir, str(size))
+            os.makedirs(size_dir, exist_ok=True)
+            for tool, record in run_benchmark(size, size_dir, args.extension, args.workers).items():
+                results.setdefault(tool, []).append(dict(size=size, **record))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    benchmark = dict(
+        created=datetime.datetime.now().isoformat(timespec='seconds'),
+        cpu_count=os.cpu_count(),
+        extension=args.extension,
+        workers=args.workers,
+        sizes=sorted(args.sizes),
+        tools={
+            tool: dict(
+                scaling_exponent=scaling_exponent(
+                    [record['size'] for record in records], [record['duration'] for record in records]),
+                curve=records)
+            for tool, records in results.items()
+        })
+
+    with open(args.output, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+
+    for tool, result in benchmark['tools'].items():
+        print('{:32} {}  exponent {}'.format(
+            tool,
+            '  '.join('{}: {:.2f} s'.format(record['size'], record['duration']) for record in result['curve']),
+            '{:.2f}'.format(result['scaling_exponent']) if result['scaling_exponent'] is not None else '-'))
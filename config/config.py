@@ -18,39 +18,172 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 -------------------------------------------------------------------------------
 """
 
-#!/usr/bin/python
+import os
+import functools
 from configparser import ConfigParser
 
-def paths_config(filename='config/config.ini', section='paths'):
-    # create a parser
-    parser = ConfigParser()
-    # read config file
-    parser.read(filename)
+# required paths, input paths must exist
+REQUIRED_PATHS = [
+    'mask',
+    'inputs_dir_landuse_tiles', 'tileset_landuse', 'tileset_mask_landuse', 'landuse_vrt', 'landuse_fit',
+    'inputs_dir_dem_tiles', 'tileset_dem', 'tileset_mask_dem', 'dem_vrt',
+    'hydro_network', 'hydro_network_output', 'sources'
+]
+INPUT_PATHS = ['mask', 'inputs_dir_landuse_tiles', 'inputs_dir_dem_tiles', 'hydro_network']
 
-    # get section
-    paths = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            paths[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+# parameters type and default value, None for a required parameter
+PARAMETERS = {
+    'landuse_extension': (str, None),
+    'dem_extension': (str, None),
+    'dem_name_pattern': (str, ''),
+    'dem_tile_size': (float, 0.0),
+    'dem_name_unit': (float, 1000.0),
+    'dem_name_origin': (('upper-left', 'lower-left'), 'upper-left'),
+    'dem_name_offset': (float, 0.0),
+    'dem_name_sample': (int, 0),
+    'crs': (int, None),
+    'workers': (int, 4),
+    'jobs': (int, 3),
+    'gdal_cachemax': (int, 512),
+    'warp_memory': (int, 1024),
+    'cog_compress': (str, 'DEFLATE'),
+    'cog_predictor': (('YES', 'NO', 'STANDARD', 'FLOATING_POINT'), 'YES'),
+    'staging_mode': (('none', 'copy', 'hardlink', 'symlink', 'reflink'), 'none'),
+    'network_columnar': (bool, False),
+    'network_clip_mode': (('select', 'cut'), 'select'),
+    'network_snap_distance': (float, 1.0)
+}
 
-    return paths
+BOOLEANS = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
+
+class Config:
+    """
+    Workflow configuration: file paths and typed parameters.
+
+    Use load_config to read it from an INI file with a [paths] and a
+    [parameters] section. Optional paths are empty strings when missing, and
+    missing optional parameters get their default value.
+    """
+
+    def __init__(self, paths, params, filename=None):
+        self.paths = paths
+        self.params = params
+        self.filename = filename
+
+    def check_paths(self):
+        """
+        Check that the input paths exist and that the output folders exist.
+
+        Raises:
+        - ValueError: With all the missing paths.
+        """
+        errors = list()
+
+        for name, path in self.paths.items():
+            if not path:
+                continue
+            if name in INPUT_PATHS:
+                if not os.path.exists(path):
+                    errors.append('%s: %s does not exist' % (name, path))
+            elif not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+                errors.append('%s: folder of %s does not exist' % (name, path))
+
+        if errors:
+            raise ValueError('Invalid paths in {}:\n{}'.format(self.filename, '\n'.join(errors)))
+
+@functools.lru_cache(maxsize=None)
+def read_config(filename):
+    """
+    Parse the INI file once, the parser is cached by file name.
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError('Config file {} not found'.format(filename))
 
-def parameters_config(filename='config/config.ini', section='parameters'):
-    # create a parser
     parser = ConfigParser()
-    # read config file
     parser.read(filename)
 
-    # get section
-    parameters = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            parameters[param[0]] = param[1]
-    else:
+    return parser
+
+def convert_parameter(name, value):
+    """
+    Convert a parameter value string to its type, raise ValueError if invalid.
+    """
+    kind, _ = PARAMETERS[name]
+
+    if isinstance(kind, tuple):
+        if value not in kind:
+            raise ValueError('%s: %s is not one of %s' % (name, value, ', '.join(kind)))
+        return value
+
+    if kind is bool:
+        if value.lower() not in BOOLEANS:
+            raise ValueError('%s: %s is not a boolean' % (name, value))
+        return BOOLEANS[value.lower()]
+
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError('%s: %s is not a valid %s' % (name, value, kind.__name__))
+
+@functools.lru_cache(maxsize=None)
+def load_config(filename='config/config.ini'):
+    """
+    Load and validate the workflow configuration, once per file.
+
+    Parameters:
+    - filename (str): Optional. Path to the INI file. Default is 'config/config.ini'.
+
+    Returns:
+    - Config: The paths and the typed parameters.
+
+    Raises:
+    - ValueError: With all the missing or invalid values.
+    """
+    parser = read_config(os.path.abspath(filename))
+    errors = list()
+
+    for section in ('paths', 'parameters'):
+        if not parser.has_section(section):
+            raise ValueError('Section {0} not found in the {1} file'.format(section, filename))
+
+    paths = dict(parser.items('paths'))
+
+    for name in REQUIRED_PATHS:
+        if not paths.get(name):
+            errors.append('%s: missing path' % name)
+
+    params = dict()
+    values = dict(parser.items('parameters'))
+
+    for name, (_, default) in PARAMETERS.items():
+        if values.get(name, '') == '':
+            if default is None:
+                errors.append('%s: missing parameter' % name)
+            params[name] = default
+        else:
+            try:
+                params[name] = convert_parameter(name, values[name])
+            except ValueError as error:
+                errors.append(str(error))
+
+    if errors:
+        raise ValueError('Invalid config file {}:\n{}'.format(filename, '\n'.join(errors)))
+
+    return Config(paths, params, filename)
+
+def paths_config(filename='config/config.ini', section='paths'):
+    """
+    Return a section of the config file as a dict of strings.
+    """
+    parser = read_config(os.path.abspath(filename))
+
+    if not parser.has_section(section):
         raise Exception('Section {0} not found in the {1} file'.format(section, filename))
 
-    return parameters
+    return dict(parser.items(section))
+
+def parameters_config(filename='config/config.ini', section='parameters'):
+    """
+    Return a section of the config file as a dict of strings.
+    """
+    return paths_config(filename, section)
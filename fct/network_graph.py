@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+-------------------------------------------------------------------------------
+"This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import shutil
+import tempfile
+import click
+import fiona
+import numpy as np
+import fct.report
+import fct.vector_tools
+
+def csr(keys, size):
+    """
+    Group the indices of `keys` by key value: the indices of key k are
+    indices[offsets[k]:offsets[k + 1]], in increasing order.
+    """
+    indices = np.argsort(keys, kind='stable')
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(keys, minlength=size))
+
+    return offsets, indices
+
+
+def expand(offsets, indices, keys):
+    """
+    Concatenate the CSR groups of several keys.
+    """
+    starts = offsets[keys]
+    counts = offsets[keys + 1] - starts
+    total = counts.sum()
+
+    if total == 0:
+        return np.zeros(0, dtype=indices.dtype)
+
+    # position of each output item in its group
+    position = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return indices[np.repeat(starts, counts) + position]
+
+
+# arrays of a NetworkGraph saved by NetworkGraph.save
+GRAPH_ARRAYS = (
+    'node_a', 'node_b', 'length',
+    'out_offsets', 'out_reaches', 'in_offsets', 'in_reaches',
+    'order', 'level_offsets'
+)
+
+class NetworkGraph:
+    """
+    Compact hydrologic network graph, in NumPy arrays indexed by reach (the
+    network features in reading order) or by node (the quantized reach
+    endpoints, like in IdentifyNetworkNodes):
+
+    - node_a, node_b: upstream and downstream node of each reach.
+    - length: length of each reach.
+    - order, level_offsets: reaches in topological order, by levels: all the
+      reaches flowing into a reach are in lower levels. The reaches of
+      level i are order[level_offsets[i]:level_offsets[i + 1]]. Reaches on a
+      cycle, or downstream of one, are not in the order.
+
+    The reaches flowing into and out of each node are CSR arrays built from
+    node_a and node_b. Accumulation queries are vectorized by level, so they
+    run in linear time in the number of reaches.
+    """
+
+    def __init__(self, node_a, node_b, length, order=None, level_offsets=None):
+        self.node_a = np.asarray(node_a, dtype=np.int64)
+        self.node_b = np.asarray(node_b, dtype=np.int64)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.node_count = int(max(self.node_a.max(initial=-1), self.node_b.max(initial=-1)) + 1)
+
+        # reaches flowing out of / into each node
+        self.out_offsets, self.out_reaches = csr(self.node_a, self.node_count)
+        self.in_offsets, self.in_reaches = csr(self.node_b, self.node_count)
+
+        if order is None:
+            order, level_offsets = self.topological_levels()
+
+        self.order = np.asarray(order, dtype=np.int64)
+        self.level_offsets = np.asarray(level_offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.node_a)
+
+    @property
+    def downstream(self):
+        """
+        First reach flowing out of the downstream node of each reach, -1 at the outlets.
+        """
+        downstream = np.full(len(self), -1, dtype=np.int64)
+        flowing = self.out_offsets[self.node_b + 1] > self.out_offsets[self.node_b]
+        downstream[flowing] = self.out_reaches[self.out_offsets[self.node_b[flowing]]]
+
+        return downstream
+
+    def levels(self):
+        """
+        Iterate over the reaches of each level, from the sources to the outlets.
+        """
+        for start, end in zip(self.level_offsets[:-1], self.level_offsets[1:]):
+            yield self.order[start:end]
+
+    def topological_levels(self):
+        """
+        Kahn traversal by levels: a reach is in the level after the last of
+        the reaches flowing into its upstream node.
+
+        Returns:
+        - numpy.ndarray: The reaches in topological order.
+        - numpy.ndarray: The levels offsets in the order.
+        """
+        pending = np.bincount(self.node_b, minlength=self.node_count)
+        frontier = expand(self.out_offsets, self.out_reaches, np.flatnonzero(pending == 0))
+        order = []
+        level_offsets = [0]
+
+        while len(frontier):
+            order.append(frontier)
+            level_offsets.append(level_offsets[-1] + len(frontier))
+
+            # nodes whose inflowing reaches are all done release their outflowing reaches
+            nodes, counts = np.unique(self.node_b[frontier], return_counts=True)
+            pending[nodes] -= counts
+            frontier = expand(self.out_offsets, self.out_reaches, nodes[pending[nodes] == 0])
+
+        order = np.concatenate(order) if order else np.zeros(0, dtype=np.int64)
+
+        return order, np.array(level_offsets, dtype=np.int64)
+
+    def accumulate(self, values, initial=None):
+        """
+        Sum `values` from the sources to each reach, the reach value included.
+
+        Parameters:
+        - values (numpy.ndarray): Value of each reach.
+        - initial (numpy.ndarray): Optional. Value of the source reaches, instead of `values`.
+
+        Returns:
+        - numpy.ndarray: Accumulated value of each reach, NaN for the reaches out of the order.
+        """
+        node_sum = np.zeros(self.node_count, dtype=np.float64)
+        has_inflow = np.bincount(self.node_b, minlength=self.node_count) > 0
+        result = np.full(len(self), np.nan)
+
+        for reaches in self.levels():
+            upstream = node_sum[self.node_a[reaches]]
+            result[reaches] = upstream + values[reaches]
+
+            if initial is not None:
+                sources = ~has_inflow[self.node_a[reaches]]
+                result[reaches[sources]] = initial[reaches[sources]]
+
+            np.add.at(node_sum, self.node_b[reaches], result[reaches])
+
+        return result
+
+    def shreve_order(self):
+        """
+        Shreve magnitude: 1 for the source reaches, the sum of the inflowing reaches magnitudes for the others.
+        """
+        return self.accumulate(np.zeros(len(self)), initial=np.ones(len(self)))
+
+    def is_source(self):
+        """
+        True for the source reaches, with no reach flowing into their upstream node.
+        """
+        return self.in_offsets[self.node_a + 1] == self.in_offsets[self.node_a]
+
+    def strahler_order(self):
+        """
+        Strahler order: 1 for the source reaches, the highest order of the
+        reaches flowing into the upstream node for the others, plus one when
+        at least two of them have this order (confluences of more than two
+        reaches included). 0 for the reaches out of the order.
+        """
+        result = np.zeros(len(self), dtype=np.int64)
+
+        for reaches in self.levels():
+            # the reaches flowing into a node are all in the lower levels
+            nodes, inverse = np.unique(self.node_a[reaches], return_inverse=True)
+            counts = self.in_offsets[nodes + 1] - self.in_offsets[nodes]
+            upstream = result[expand(self.in_offsets, self.in_reaches, nodes)]
+            node_order = np.ones(len(nodes), dtype=np.int64)
+
+            if len(upstream):
+                inflow = counts > 0
+                starts = (np.cumsum(counts) - counts)[inflow]
+                highest = np.maximum.reduceat(upstream, starts)
+                ties = np.add.reduceat(upstream == np.repeat(highest, counts[inflow]), starts)
+                node_order[inflow] = highest + (ties > 1)
+
+            result[reaches] = node_order[inverse.reshape(-1)]
+
+        return result
+
+    def upstream_length(self):
+        """
+        Total length of the reaches upstream of each reach, the reach included.
+        At a divergence, the upstream length is counted in every outflowing reach.
+        """
+        return self.accumulate(self.length)
+
+    def distance_to_outlet(self):
+        """
+        Length of the shortest path from the upstream end of each reach to an outlet, the reach included.
+        """
+        node_distance = np.full(self.node_count, np.inf)
+        node_distance[np.bincount(self.node_a, minlength=self.node_count) == 0] = 0.0
+        result = np.full(len(self), np.nan)
+
+        # from the outlets to the sources, the downstream reaches are in higher levels
+        for reaches in reversed(list(self.levels())):
+            result[reaches] = self.length[reaches] + node_distance[self.node_b[reaches]]
+            np.minimum.at(node_distance, self.node_a[reaches], result[reaches])
+
+        # reaches flowing to a cycle
+        result[np.isinf(result)] = np.nan
+
+        return result
+
+    def save(self, path):
+        """
+        Save the graph arrays to .npy files in the `path` folder, written to a
+        temporary folder renamed at the end, like the spatial indexes.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='tmp.', dir=os.path.dirname(os.path.abspath(path)))
+
+        try:
+            for name in GRAPH_ARRAYS:
+                np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name))
+
+            try:
+                os.rename(tmp_dir, path)
+            except OSError:
+                # another run saved the same graph first
+                if not os.path.exists(os.path.join(path, 'node_a.npy')):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a graph saved with save, its arrays memory-mapped read-only.
+        """
+        graph = cls.__new__(cls)
+
+        for name in GRAPH_ARRAYS:
+            setattr(graph, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+        graph.node_count = len(graph.out_offsets) - 1
+
+        return graph
+
+    @classmethod
+    def from_network(cls, network, cache_path=None, batch_size=10000):
+        """
+        Build the graph of a hydrologic network, with lines digitized from upstream to downstream.
+
+        The network is read once, by batches of features (see
+        fct.vector_tools.read_line_endpoints), only the endpoints and lengths are kept.
+        With `cache_path`, the graph is saved to a subfolder of this folder named
+        after the size and the modification time of the network, and memory-mapped
+        from it on the next calls, until the network file changes.
+
+        Parameters:
+        - network (str): Path to the hydrologic network file.
+        - cache_path (str): Optional. Path to the graph cache folder. Default is None, no cache.
+        - batch_size (int): Optional. Number of features read at once. Default is 10000.
+
+        Returns:
+        - NetworkGraph: The network graph.
+        """
+        if cache_path is not None:
+            fingerprint = fct.vector_tools.file_fingerprint(network)
+            graph_dir = os.path.join(cache_path, fingerprint)
+
+            if os.path.exists(os.path.join(graph_dir, 'node_a.npy')):
+                return cls.load(graph_dir)
+
+        click.secho('Build network graph of %s' % network, fg='yellow')
+
+        coordinates, length = fct.vector_tools.read_line_endpoints(network, batch_size)
+        endpoints_gid, _ = fct.vector_tools.index_endpoints(coordinates)
+        graph = cls(endpoints_gid[0::2], endpoints_gid[1::2], length)
+
+        if cache_path is not None:
+            os.makedirs(cache_path, exist_ok=True)
+            graph.save(graph_dir)
+
+            # remove the graphs of the previous versions of the network file
+            for name in os.listdir(cache_path):
+                if name != fingerprint and not name.startswith('tmp.'):
+                    shutil.rmtree(os.path.join(cache_path, name), ignore_errors=True)
+
+        return graph
+
+
+@fct.report.instrument
+def NetworkMetrics(network, output_network, cache_path=None):
+    """
+    Add upstream accumulation metrics to the hydrologic network lines, from its compact graph:
+
+    - SHREVE: Shreve magnitude.
+    - UPLENGTH: Total length of the upstream network, the line included.
+    - OUTDIST: Distance from the upstream end of the line to the outlet, the line included.
+
+    The lines on a cycle, or downstream of one, get null metrics.
+
+    Parameters:
+    - network (str): Path to the hydrologic network file.
+    - output_network (str): Path to the output network, with the metrics fields.
+    - cache_path (str): Optional. Path to the graph cache folder, see NetworkGraph.from_network. Default is None.
+
+    Returns:
+    - None
+    """
+    graph = NetworkGraph.from_network(network, cache_path)
+    fct.report.count(len(graph), 'features')
+
+    click.secho('Compute Shreve order, upstream length and distance to outlet', fg='yellow')
+
+    shreve = graph.shreve_order()
+    upstream_length = graph.upstream_length()
+    outlet_distance = graph.distance_to_outlet()
+
+    def value(array, i, kind=float):
+        return None if np.isnan(array[i]) else kind(array[i])
+
+    with fiona.open(network) as fs:
+        schema = fs.schema.copy()
+        schema['properties']['SHREVE'] = 'int'
+        schema['properties']['UPLENGTH'] = 'float'
+        schema['properties']['OUTDIST'] = 'float'
+        options = dict(driver=fs.driver, crs=fs.crs, schema=schema)
+
+        with fiona.open(output_network, 'w', **options) as dst:
+            # features are read in the same order as when building the graph
+            dst.writerecords(
+                {
+                    'type': 'Feature',
+                    'geometry': feature['geometry'],
+                    'properties': {
+                        **feature['properties'],
+                        'SHREVE': value(shreve, i, int),
+                        'UPLENGTH': value(upstream_length, i),
+                        'OUTDIST': value(outlet_distance, i)
+                    }
+                }
+                for i, feature in enumerate(fs)
+            )
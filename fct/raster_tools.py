@@ -2,42 +2,121 @@
 
 # packages
 import rasterio
-from rasterio.merge import merge
-from rasterio.mask import mask
+import rasterio.crs
+import rasterio.transform
+import rasterio.windows
+import rasterio.features
+import contextlib
 import glob
+import hashlib
 import os
+import re
+import shutil
+import time
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, reflink falls back on copy
+    fcntl = None
 import fiona
-from shapely.geometry import shape
+import numpy as np
+import shapely
+from shapely.geometry import shape, box
 import fct.utils
-
-from config.config import paths_config, parameters_config
+import fct.report
 import subprocess
 
 
-paths = paths_config()
-params = parameters_config()
+@fct.report.instrument
+def fit_raster_pixel (
+        raster_to_fit,
+        reference_raster,
+        output_raster,
+        resampling: str = 'mode',
+        threads: str = 'ALL_CPUS',
+        cache_max: int = 512,
+        warp_memory: int = 1024,
+        compress: str = 'DEFLATE'):
+    """
+    Warp a raster on the exact grid of a reference raster with gdalwarp.
 
+    The output has the reference CRS, bounds and shape. The default `mode`
+    resampling keeps the categorical values of landuse rasters. Warping is
+    multithreaded on `threads` threads, with a GDAL cache of `cache_max` MB and
+    a warp memory of `warp_memory` MB. The output is a tiled and `compress`
+    compressed GeoTIFF, written as BigTIFF when it may exceed 4 GB.
+    """
+    with rasterio.open(reference_raster) as ref_raster:
+        bounds = ref_raster.bounds
+        height, width = ref_raster.shape
+        ref_crs = ref_raster.crs
 
-def fit_raster_pixel (raster_to_fit, reference_raster, output_raster):
-    
-    ref_raster = rasterio.open(reference_raster)
+    fct.report.count(width * height, 'pixels')
 
-    command = 'gdalwarp -te {} {} {} {} "{}" "{}" '.format(
-        ref_raster.bounds[0], ref_raster.bounds[1], ref_raster.bounds[2], ref_raster.bounds[3], raster_to_fit, output_raster)
+    command = ('gdalwarp -overwrite -t_srs "{}" -te {} {} {} {} -ts {} {} -r {} '
+               '-multi -wo NUM_THREADS={} -wm {} --config GDAL_CACHEMAX {} '
+               '-co TILED=YES -co COMPRESS={} -co NUM_THREADS={} -co BIGTIFF=IF_SAFER '
+               '"{}" "{}"').format(
+        ref_crs.to_string(), bounds[0], bounds[1], bounds[2], bounds[3], width, height, resampling,
+        threads, warp_memory, cache_max, compress, threads, raster_to_fit, output_raster)
     
     fct.utils.process_with_stdout(command)
     
 
 
+@fct.report.instrument
+def CreateCloudOptimizedGeoTiff(
+        input_raster,
+        output_raster,
+        resampling: str = 'average',
+        compress: str = 'DEFLATE',
+        predictor: str = 'YES',
+        threads: str = 'ALL_CPUS',
+        cache_max: int = 512):
+    """
+    Write a raster (e.g. a virtual raster) as a Cloud Optimized GeoTIFF with gdal_translate.
+
+    The COG driver writes an internally tiled raster with overviews, built
+    with `resampling`: 'mode' for categorical rasters such as the landuse,
+    'average' for continuous ones such as the DEM. Compression and overviews
+    are computed on `threads` threads. `predictor` is YES (chosen from the
+    data type), NO, STANDARD or FLOATING_POINT.
+    """
+    with rasterio.open(input_raster) as src:
+        height, width = src.shape
+
+    fct.report.count(width * height, 'pixels')
+
+    command = ('gdal_translate -of COG --config GDAL_CACHEMAX {} '
+               '-co COMPRESS={} -co PREDICTOR={} -co OVERVIEW_RESAMPLING={} '
+               '-co NUM_THREADS={} -co BIGTIFF=IF_SAFER '
+               '"{}" "{}"').format(
+        cache_max, compress, predictor, resampling.upper(), threads, input_raster, output_raster)
+
+    fct.utils.process_with_stdout(command)
+
+@fct.report.instrument
 def merge_raster_in_folder(
         input_raster_folder_path: str,
         output_merge_raster_folder_path: str,
         extension: str,
         compress: str = 'deflate',
-        zlevel: int = 9):
+        zlevel: int = 9,
+        memory_budget: int = 1024,
+        workers: int = 4):
     """
     Merge all the raster file contain in a folder in Gtiff
     documentation : https://automating-gis-processes.github.io/CSC18/lessons/L6/raster-mosaic.html
+
+    The mosaic is streamed block by block: for each output block, only the
+    rasters overlapping it (found with a STRtree of the raster footprints) are
+    read, through windowed reads, and merged with the max value. Blocks are
+    processed in a thread pool of `workers` threads, and their size is set so
+    that the blocks in memory stay within `memory_budget` MB, whatever the
+    mosaic size. The output is a tiled GeoTIFF, BigTIFF when needed.
     """
     # Make a search criteria to select the tiff raster files
     search_criteria = '*'+extension
@@ -45,48 +124,227 @@ def merge_raster_in_folder(
     q = os.path.join(input_raster_folder_path, search_criteria)
 
     # list all raster file
-    rasterInFolder = glob.glob(q)
+    rasterInFolder = sorted(glob.glob(q))
 
-    # create an empty list to gather the list of the raster name
-    rasterListToMerge = []
+    if not rasterInFolder:
+        raise ValueError('No raster %s in %s' % (search_criteria, input_raster_folder_path))
 
-    # read all the raster with rasterio and add it to the rasterListToMerge list
+    # read the raster footprints, the output metadata is copied from the first raster
+    footprints = []
     for raster in rasterInFolder:
-        item = rasterio.open(raster)
-        rasterListToMerge.append(item)
+        with rasterio.open(raster) as item:
+            footprints.append(box(*item.bounds))
+            if len(footprints) == 1:
+                out_meta = item.meta.copy()
+                resx, resy = item.res
+
+    footprints_index = shapely.STRtree(footprints)
+
+    minx, miny, maxx, maxy = shapely.total_bounds(footprints)
+    width = int(round((maxx - minx) / resx))
+    height = int(round((maxy - miny) / resy))
+    out_transform = rasterio.transform.from_origin(minx, maxy, resx, resy)
 
-    # Merge function
-    mergeRaster, mergeRaster_trans = merge(datasets = rasterListToMerge, method='max')
+    count = out_meta['count']
+    dtype = np.dtype(out_meta['dtype'])
+    nodata = out_meta['nodata']
 
-    # Copy the metadata
-    out_meta = rasterListToMerge[0].meta.copy()
+    fct.report.count(width * height, 'pixels')
+
+    # block side, a multiple of the 256 pixels GeoTIFF tiles, for the values,
+    # the source window and the filled mask of each running block
+    block_bytes = memory_budget * 2**20 / max(1, workers)
+    pixel_bytes = count * (2 * dtype.itemsize + 1)
+    block_size = max(256, int((block_bytes / pixel_bytes) ** 0.5) // 256 * 256)
 
     # Update the metadata
     out_meta.update({"driver": 'GTiff',
-                    "height": mergeRaster.shape[1],
-                    "width": mergeRaster.shape[2],
-                    "transform": mergeRaster_trans,
+                    "height": height,
+                    "width": width,
+                    "transform": out_transform,
                     "compress": compress,
-                    "zlevel": zlevel
+                    "zlevel": zlevel,
+                    "tiled": True,
+                    "blockxsize": 256,
+                    "blockysize": 256,
+                    "BIGTIFF": 'IF_SAFER'
                     }
                     )
-    
+
+    write_lock = threading.Lock()
+
+    def merge_block(dest, window):
+        """ Merge the rasters overlapping an output block and write it
+        """
+        block_minx, block_miny, block_maxx, block_maxy = rasterio.windows.bounds(window, out_transform)
+        values = np.zeros((count, window.height, window.width), dtype=dtype)
+        filled = np.zeros((window.height, window.width), dtype=bool)
+
+        for i in footprints_index.query(box(block_minx, block_miny, block_maxx, block_maxy), predicate='intersects'):
+            raster_minx, raster_miny, raster_maxx, raster_maxy = footprints[i].bounds
+
+            # overlap in block pixels
+            col0 = int(round((max(block_minx, raster_minx) - block_minx) / resx))
+            col1 = int(round((min(block_maxx, raster_maxx) - block_minx) / resx))
+            row0 = int(round((block_maxy - min(block_maxy, raster_maxy)) / resy))
+            row1 = int(round((block_maxy - max(block_miny, raster_miny)) / resy))
+
+            if col1 <= col0 or row1 <= row0:
+                continue
+
+            with rasterio.open(rasterInFolder[i]) as src:
+                src_window = rasterio.windows.from_bounds(
+                    block_minx + col0 * resx, block_maxy - row1 * resy,
+                    block_minx + col1 * resx, block_maxy - row0 * resy,
+                    transform=src.transform)
+                data = src.read(window=src_window, out_shape=(count, row1 - row0, col1 - col0), masked=True)
+
+            valid = ~np.ma.getmaskarray(data).any(axis=0)
+            region = values[:, row0:row1, col0:col1]
+            region_filled = filled[row0:row1, col0:col1]
+
+            # max merge method, the first valid value is copied
+            region[:, valid] = np.where(
+                region_filled[valid],
+                np.maximum(region[:, valid], data.data[:, valid]),
+                data.data[:, valid])
+            region_filled |= valid
+
+        if nodata is not None:
+            values[:, ~filled] = nodata
+
+        with write_lock:
+            dest.write(values, window=window)
+
+    windows = [
+        rasterio.windows.Window(col, row, min(block_size, width - col), min(block_size, height - row))
+        for row in range(0, height, block_size)
+        for col in range(0, width, block_size)
+    ]
+
     # Write the mosaic raster to disk
     with rasterio.open(output_merge_raster_folder_path + 'merge_raster.tif', "w", **out_meta) as dest:
-        dest.write(mergeRaster)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # raise the first block error
+            for _ in executor.map(lambda window: merge_block(dest, window), windows):
+                pass
+
+def read_raster_header(raster_path: str):
+    """
+    Read the bounds, resolution and nodata of a raster from its header, without reading any pixel.
+    """
+    with rasterio.open(raster_path) as src:
+        return dict(
+            bounds=tuple(src.bounds),
+            res=src.res,
+            nodata=src.nodata)
+
+def read_tileset_manifest(tileset_path: str):
+    """
+    Read the manifest stored in an existing tileset, as a dict of tile properties by tile NAME.
+
+    An empty manifest is returned if the tileset does not exist or has been
+    created without the manifest fields.
+    """
+    manifest = dict()
+
+    if not os.path.exists(tileset_path):
+        return manifest
+
+    with fiona.open(tileset_path) as src:
+        if not all(field in src.schema['properties'] for field in ('SIZE', 'MTIME', 'X1', 'Y1')):
+            return manifest
+
+        for feature in src:
+            properties = dict(feature['properties'])
+            manifest[properties['NAME']] = properties
+
+    return manifest
+
+def tile_bounds_from_name(
+        name: str,
+        name_pattern,
+        tile_size: float,
+        name_unit: float = 1000,
+        name_origin: str = 'upper-left',
+        name_offset: float = 0):
+    """
+    Compute the bounds of a regular grid tile from its file name.
+
+    `name_pattern` is a compiled regex with named groups `x` and `y`, the tile
+    corner coordinates in `name_unit` map units (e.g. kilometers for
+    RGEALTI_FXX_0948_6457_MNT_LAMB93_IGN69.asc). `name_origin` tells which
+    corner is encoded, 'upper-left' or 'lower-left', and `name_offset` is added
+    to both coordinates (e.g. -0.5 for half pixel registered 1 m tiles).
+
+    Returns None if the name does not match the pattern.
+    """
+    match = name_pattern.search(name)
+
+    if match is None:
+        return None
 
+    minx = float(int(match.group('x')) * name_unit + name_offset)
+    y = float(int(match.group('y')) * name_unit + name_offset)
+
+    if name_origin == 'upper-left':
+        maxy = y
+        miny = y - tile_size
+    elif name_origin == 'lower-left':
+        miny = y
+        maxy = y + tile_size
+    else:
+        raise ValueError('Unsupported name origin %s, expected upper-left or lower-left' % name_origin)
+
+    return (minx, miny, minx + tile_size, maxy)
+
+@fct.report.instrument
 def CreateTilesetFromRasters(
         input_dir_path: str,
         extension: str,
         tileset_path: str,
-        crs: str = '2154'):
-    
+        crs: str = '2154',
+        workers: int = 1,
+        batch_size: int = 1000,
+        update: bool = True,
+        name_pattern: str = None,
+        tile_size: float = None,
+        name_unit: float = 1000,
+        name_origin: str = 'upper-left',
+        name_offset: float = 0,
+        name_sample: int = 0):
+    """
+    Create a tileset GeoPackage with the footprint of every raster of a folder.
+
+    Each tile feature also stores a manifest of the raster file (SIZE, MTIME,
+    bounds, resolution and nodata). With `update`, the manifest of an existing
+    tileset is reused: only new or changed rasters (by size and mtime) are
+    opened, and the tiles of deleted rasters are dropped.
+
+    For regular grid tile products, `name_pattern` and `tile_size` enable the
+    naming mode: tile bounds are computed from the file names only (see
+    tile_bounds_from_name), the rasters are not opened and SIZE/MTIME are left
+    empty. `name_sample` rasters are opened to check the pattern against their
+    headers and to fill RESX, RESY and NODATA. Names not matching the pattern
+    fall back to a header read.
+
+    Raster headers are read in a thread pool of `workers` threads, the features
+    are written in batches of `batch_size` by a single writer. The scan rate
+    in files per second is printed at the end.
+    """
     schema = { 
     'geometry': 'Polygon', 
     'properties': {'GID': 'int',
                     'NAME': 'str',
                     'X0': 'float',
-                    'Y0': 'float'} }
+                    'Y0': 'float',
+                    'X1': 'float',
+                    'Y1': 'float',
+                    'RESX': 'float',
+                    'RESY': 'float',
+                    'NODATA': 'float',
+                    'SIZE': 'int',
+                    'MTIME': 'float'} }
     
     options = dict(
         driver='GPKG',
@@ -99,63 +357,586 @@ def CreateTilesetFromRasters(
     q = os.path.join(input_dir_path, search_criteria)
 
     # list all raster file
-    rasterInFolder = glob.glob(q)
-
-    gid = 1
-    with fiona.open(tileset_path, 'w', **options) as dst:
-        # read all the raster with rasterio and add it to the rasterListToMerge list
-        for raster in rasterInFolder:
-            with rasterio.open(raster) as src:
-                minx, miny, maxx, maxy = src.bounds
+    rasterInFolder = sorted(glob.glob(q))
+    fct.report.count(len(rasterInFolder), 'tiles')
+
+    manifest = read_tileset_manifest(tileset_path) if update else dict()
+
+    start_time = time.perf_counter()
+
+    sample_header = dict(res=(None, None), nodata=None)
+
+    if name_pattern is not None:
+        if tile_size is None:
+            raise ValueError('tile_size is required with name_pattern')
+
+        name_pattern = re.compile(name_pattern)
+        manifest = dict()
+
+        # check the pattern on a few rasters evenly spread in the folder
+        if name_sample > 0 and rasterInFolder:
+            step = max(1, len(rasterInFolder) // name_sample)
+            for raster in rasterInFolder[::step][:name_sample]:
+                name_bounds = tile_bounds_from_name(
+                    os.path.basename(raster), name_pattern, tile_size, name_unit, name_origin, name_offset)
+                sample_header = read_raster_header(raster)
+
+                if name_bounds is not None and not all(
+                        abs(a - b) <= 1e-6 * tile_size for a, b in zip(name_bounds, sample_header['bounds'])):
+                    raise ValueError('Tile bounds from name {} do not match raster bounds {} for {}'.format(
+                        name_bounds, sample_header['bounds'], raster))
+
+    def index_raster(raster):
+        """ Return the manifest entry of a raster and whether its header has been read
+        """
+        name = os.path.basename(raster)
+
+        if name_pattern is not None:
+            bounds = tile_bounds_from_name(name, name_pattern, tile_size, name_unit, name_origin, name_offset)
+
+            if bounds is not None:
+                minx, miny, maxx, maxy = bounds
+                resx, resy = sample_header['res']
+
+                return {
+                    'NAME': name,
+                    'X0': minx,
+                    'Y0': miny,
+                    'X1': maxx,
+                    'Y1': maxy,
+                    'RESX': resx,
+                    'RESY': resy,
+                    'NODATA': sample_header['nodata'],
+                    'SIZE': None,
+                    'MTIME': None
+                }, False
+
+        stat = os.stat(raster)
+        cached = manifest.get(name)
+
+        if cached is not None and cached['SIZE'] == stat.st_size and cached['MTIME'] == stat.st_mtime:
+            return cached, False
+
+        header = read_raster_header(raster)
+        minx, miny, maxx, maxy = header['bounds']
+        resx, resy = header['res']
+
+        return {
+            'NAME': name,
+            'X0': minx,
+            'Y0': miny,
+            'X1': maxx,
+            'Y1': maxy,
+            'RESX': resx,
+            'RESY': resy,
+            'NODATA': header['nodata'],
+            'SIZE': stat.st_size,
+            'MTIME': stat.st_mtime
+        }, True
+
+    read_count = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # stat and read the raster headers, map keeps the files order
+        entries = executor.map(index_raster, rasterInFolder)
+
+        with fiona.open(tileset_path, 'w', **options) as dst:
+            batch = []
+            for gid, (entry, read) in enumerate(entries, start=1):
+                read_count += read
+                minx, miny, maxx, maxy = entry['X0'], entry['Y0'], entry['X1'], entry['Y1']
                 coordinates = [(minx,miny), (minx,maxy), (maxx,maxy), (maxx,miny)]
                 # Define the feature properties and geometry.
-                feature = {
+                batch.append({
                     'geometry': {
                         'type':'Polygon',
                         'coordinates': [coordinates] 
                     },
-                    'properties': {
-                        'GID': gid,
-                        'NAME': os.path.basename(raster),
-                        'Y0': minx,
-                        'X0': miny
-                    }
-                }
-            # Write only features that intersect with the study area.
-            dst.write(feature)
-            gid += 1
+                    'properties': {**entry, 'GID': gid}
+                })
+
+                if len(batch) == batch_size:
+                    dst.writerecords(batch)
+                    batch = []
+
+            if batch:
+                dst.writerecords(batch)
+
+    elapsed = time.perf_counter() - start_time
+    removed_count = len(set(manifest) - set(os.path.basename(raster) for raster in rasterInFolder))
+    print('{} rasters indexed in {:.1f} s ({:.1f} files/s), {} headers read, {} tiles removed'.format(
+        len(rasterInFolder), elapsed, len(rasterInFolder) / elapsed if elapsed > 0 else 0,
+        read_count, removed_count))
             
+# Linux ioctl to share the extents of a file (copy on write clone)
+FICLONE = 0x40049409
+
+def copy_file(src_path: str, dest_path: str):
+    """
+    Copy a file in the kernel with copy_file_range, falling back on
+    shutil.copyfile (sendfile on Linux, fcopyfile on macOS) when it is not
+    supported, and keep the source mtime.
+    """
+    src_stat = os.stat(src_path)
+
+    try:
+        with open(src_path, 'rb') as src_file, open(dest_path, 'wb') as dest_file:
+            remaining = src_stat.st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src_file.fileno(), dest_file.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    except (AttributeError, OSError):
+        # copyfile truncates the partial copy
+        shutil.copyfile(src_path, dest_path)
+
+    os.utime(dest_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+def reflink_file(src_path: str, dest_path: str):
+    """
+    Clone a file with a copy on write reflink, falling back on copy_file
+    when the filesystem does not support it.
+    """
+    if fcntl is None:
+        copy_file(src_path, dest_path)
+        return
+
+    src_stat = os.stat(src_path)
+
+    try:
+        with open(src_path, 'rb') as src_file, open(dest_path, 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        copy_file(src_path, dest_path)
+        return
+
+    os.utime(dest_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+def stage_file(src_path: str, dest_path: str, mode: str = 'copy'):
+    """
+    Stage a file in a destination folder by copy, hardlink, symlink or reflink.
+
+    Returns False if the destination is already up to date and has been skipped.
+    """
+    if os.path.lexists(dest_path):
+        if mode == 'symlink':
+            if os.path.islink(dest_path) and os.readlink(dest_path) == os.path.abspath(src_path):
+                return False
+        elif mode == 'hardlink':
+            if os.path.samefile(src_path, dest_path):
+                return False
+        else:
+            src_stat = os.stat(src_path)
+            dest_stat = os.lstat(dest_path)
+            if (not os.path.islink(dest_path) and dest_stat.st_size == src_stat.st_size
+                    and dest_stat.st_mtime_ns == src_stat.st_mtime_ns):
+                return False
+
+        os.remove(dest_path)
+
+    if mode == 'copy':
+        copy_file(src_path, dest_path)
+    elif mode == 'hardlink':
+        os.link(src_path, dest_path)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src_path), dest_path)
+    elif mode == 'reflink':
+        reflink_file(src_path, dest_path)
+
+    return True
+
+@fct.report.instrument
 def ExtractRasterTilesFromTileset(
         tileset_path,
         raster_dir,
-        dest_dir):
-    
+        dest_dir,
+        mode: str = 'copy',
+        workers: int = 4):
+    """
+    Stage the raster tiles of a tileset from the tiles folder to a destination folder.
+
+    `mode` is one of 'copy' (kernel side copy), 'hardlink', 'symlink' or
+    'reflink' (copy on write clone, falling back on copy). Files already up to
+    date in the destination (same size and mtime, or same link target) are
+    skipped. Files are staged in a thread pool of `workers` threads.
+
+    Returns the list of the tile names missing in the tiles folder, which are
+    reported instead of stopping the staging.
+    """
+    if mode not in ('copy', 'hardlink', 'symlink', 'reflink'):
+        raise ValueError('Unsupported staging mode %s, expected copy, hardlink, symlink or reflink' % mode)
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    with fiona.open(tileset_path) as src:
+        filenames = [feature['properties']['NAME'] for feature in src]
+
+    fct.report.count(len(filenames), 'tiles')
+
+    missing = [filename for filename in filenames if not os.path.exists(os.path.join(raster_dir, filename))]
+    missing_set = set(missing)
+
+    def stage(filename):
+        return stage_file(os.path.join(raster_dir, filename), os.path.join(dest_dir, filename), mode)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        staged = list(executor.map(stage, [filename for filename in filenames if filename not in missing_set]))
+
+    print('{} tiles staged by {}, {} already up to date, {} missing'.format(
+        sum(staged), mode, len(staged) - sum(staged), len(missing)))
+
+    for filename in missing:
+        print('Missing tile: {}'.format(os.path.join(raster_dir, filename)))
+
+    return missing
+
+def convert_to_geotiff(src_path: str, dest_path: str, compress: str = 'DEFLATE'):
+    """
+    Convert a raster (e.g. an ESRI ASCII grid) to an internally tiled and compressed GeoTIFF.
+
+    The GeoTIFF is written to a temporary file renamed at the end, so that an
+    interrupted conversion never leaves a partial file at `dest_path`.
+    """
+    with rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+        data = src.read()
+
+    profile.update({"driver": 'GTiff',
+                    "tiled": True,
+                    "blockxsize": 256,
+                    "blockysize": 256,
+                    "compress": compress,
+                    # floating point or horizontal differencing predictor
+                    "predictor": 3 if np.dtype(profile['dtype']).kind == 'f' else 2})
+
+    # one temporary file per process, the same tile can be converted by concurrent runs sharing the cache
+    tmp_path = '{}.{}.tmp'.format(dest_path, os.getpid())
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        dst.write(data)
+
+    os.replace(tmp_path, dest_path)
+
+def file_content_key(path: str, chunk_size: int = 2**20):
+    """
+    Key of the content of a file, the first 16 hexadecimal digits of its SHA-1 hash.
+    """
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:16]
+
+@fct.report.instrument
+def ConvertTilesetToGeoTiff(
+        tileset_path: str,
+        raster_dir: str,
+        cache_dir: str,
+        output_tileset_path: str,
+        workers: int = 4,
+        compress: str = 'DEFLATE'):
+    """
+    Convert the tiles of a tileset to tiled and compressed GeoTIFFs in a cache folder.
+
+    Cache files are named after the tile and a hash of its source content
+    (see file_content_key), so a tile is converted again only when its source
+    content changes, whatever its modification time, and older conversions of
+    the tile are removed. The sources are hashed and the tiles converted in a
+    process pool of `workers` processes. The output tileset lists the cached
+    tiles, to build a virtual raster from `cache_dir` with CreateVrtFromTileset.
+
+    Every source tile is read in full to be hashed on each run, even when the
+    cache is up to date: a run with a warm cache costs one sequential read of
+    the tiles, without their decoding and compression.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    with fiona.open(tileset_path) as src:
+        options = dict(driver=src.driver, schema=src.schema.copy(), crs=src.crs)
+        features = [
+            {'geometry': feature['geometry'], 'properties': dict(feature['properties'])}
+            for feature in src
+        ]
+
+    fct.report.count(len(features), 'tiles')
+
+    rasters = [os.path.join(raster_dir, feature['properties']['NAME']) for feature in features]
+
+    with fct.utils.process_pool(workers) as executor:
+        futures = [executor.submit(fct.report.run_task, file_content_key, raster) for raster in rasters]
+        keys = []
+        for future in futures:
+            key, usage = future.result()
+            fct.report.add_task(usage)
+            keys.append(key)
+
+        conversions = []
+
+        for feature, raster, key in zip(features, rasters, keys):
+            properties = feature['properties']
+            stem = os.path.splitext(properties['NAME'])[0]
+            cache_name = '{}.{}.tif'.format(stem, key)
+            cache_file = os.path.join(cache_dir, cache_name)
+
+            if not os.path.exists(cache_file):
+                # remove the conversions of older versions of the tile, which a
+                # concurrent run sharing the cache may have removed already
+                for stale in glob.glob(os.path.join(cache_dir, glob.escape(stem) + '.*.tif')):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(stale)
+                conversions.append((raster, cache_file))
+
+            properties['NAME'] = cache_name
+
+        futures = [
+            executor.submit(fct.report.run_task, convert_to_geotiff, raster, cache_file, compress)
+            for raster, cache_file in conversions
+        ]
+        for future in futures:
+            _, usage = future.result()
+            fct.report.add_task(usage)
+
+    # cached tiles manifest
+    for feature in features:
+        properties = feature['properties']
+        if 'SIZE' in properties and 'MTIME' in properties:
+            stat = os.stat(os.path.join(cache_dir, properties['NAME']))
+            properties['SIZE'] = stat.st_size
+            properties['MTIME'] = stat.st_mtime
+
+    with fiona.open(output_tileset_path, 'w', **options) as dst:
+        dst.writerecords(features)
+
+    print('{} tiles converted, {} already in cache {}'.format(
+        len(conversions), len(features) - len(conversions), cache_dir))
+
+# GDAL data type names of the numpy data types
+GDAL_DATA_TYPES = {
+    'uint8': 'Byte',
+    'int8': 'Int8',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'float32': 'Float32',
+    'float64': 'Float64'
+}
+
+@fct.report.instrument
+def CreateVrtFromTileset(
+        tileset_path: str,
+        raster_dir: str,
+        vrt_path: str,
+        crs: str = '2154',
+        resolution: str = 'highest',
+        target_resolution: float = None,
+        nodata: float = None,
+        workers: int = 1):
+    """
+    Write a virtual raster mosaic of the tiles of a tileset, in process.
+
+    The VRT XML is written directly from the tileset features (e.g. the output
+    of ExtractBylocation), with the tiles read in place from `raster_dir`: no
+    copy, no gdalbuildvrt process and no file list are needed, and the number
+    of tiles is not limited by the command line length. Tile bounds and
+    resolution come from the tileset manifest fields when available, otherwise
+    from the raster headers read in a thread pool of `workers` threads. The
+    data type, band count and block size are read from the first tile.
+
+    `resolution` follows the gdalbuildvrt rules: 'highest', 'lowest',
+    'average', or 'user' with `target_resolution`. `nodata` overrides the
+    nodata value of the tiles.
+    """
     with fiona.open(tileset_path) as src:
-        for feature in src : 
-            filename = feature['properties']['NAME']
-            raster_file = os.path.join(raster_dir, filename)
-            dest_file = os.path.join(dest_dir, filename)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            # Ouvre le fichier source en mode lecture binaire
-            with open(raster_file, "rb") as src_file:
-                # Ouvre le fichier de destination en mode écriture binaire
-                with open(dest_file, "wb") as dest_file:
-                    # Lit le contenu du fichier source et écrit dans le fichier de destination
-                    dest_file.write(src_file.read())
-
-def ClipRasterByPolygon(raster_path, polygon_path, output_raster_path):
+        tiles = [dict(feature['properties']) for feature in src]
+
+    fct.report.count(len(tiles), 'tiles')
+
+    if not tiles:
+        raise ValueError('No tile in tileset %s' % tileset_path)
+
+    def tile_extent(tile):
+        """ Return the path, bounds and resolution of a tile
+        """
+        # absolute path, the sources are not relative to the VRT file
+        raster = os.path.abspath(os.path.join(raster_dir, tile['NAME']))
+
+        if all(tile.get(field) is not None for field in ('X0', 'Y0', 'X1', 'Y1', 'RESX', 'RESY')):
+            return raster, (tile['X0'], tile['Y0'], tile['X1'], tile['Y1']), (tile['RESX'], tile['RESY'])
+
+        header = read_raster_header(raster)
+        return raster, header['bounds'], header['res']
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        extents = list(executor.map(tile_extent, tiles))
+
+    # bands description from the first tile
+    with rasterio.open(extents[0][0]) as first:
+        dtypes = first.dtypes
+        block_shapes = first.block_shapes
+        src_nodata = first.nodata
+
+    if nodata is None:
+        nodata = src_nodata
+
+    # output grid
+    if resolution == 'highest':
+        resx = min(res[0] for _, _, res in extents)
+        resy = min(res[1] for _, _, res in extents)
+    elif resolution == 'lowest':
+        resx = max(res[0] for _, _, res in extents)
+        resy = max(res[1] for _, _, res in extents)
+    elif resolution == 'average':
+        resx = sum(res[0] for _, _, res in extents) / len(extents)
+        resy = sum(res[1] for _, _, res in extents) / len(extents)
+    elif resolution == 'user' and target_resolution is not None:
+        resx = resy = target_resolution
+    else:
+        raise ValueError('Unsupported resolution %s, expected highest, lowest, average or user with target_resolution' % resolution)
+
+    minx = min(bounds[0] for _, bounds, _ in extents)
+    miny = min(bounds[1] for _, bounds, _ in extents)
+    maxx = max(bounds[2] for _, bounds, _ in extents)
+    maxy = max(bounds[3] for _, bounds, _ in extents)
+
+    width = int(round((maxx - minx) / resx))
+    height = int(round((maxy - miny) / resy))
+
+    vrt = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(vrt, 'SRS').text = rasterio.crs.CRS.from_epsg(int(crs)).to_wkt()
+    ET.SubElement(vrt, 'GeoTransform').text = ', '.join(
+        repr(float(value)) for value in (minx, resx, 0, maxy, 0, -resy))
+
+    for band, (dtype, (block_height, block_width)) in enumerate(zip(dtypes, block_shapes), start=1):
+        data_type = GDAL_DATA_TYPES[dtype]
+        vrt_band = ET.SubElement(vrt, 'VRTRasterBand', dataType=data_type, band=str(band))
+
+        if nodata is not None:
+            ET.SubElement(vrt_band, 'NoDataValue').text = repr(float(nodata))
+
+        for raster, (x0, y0, x1, y1), (tile_resx, tile_resy) in extents:
+            tile_width = int(round((x1 - x0) / tile_resx))
+            tile_height = int(round((y1 - y0) / tile_resy))
+
+            source = ET.SubElement(vrt_band, 'ComplexSource' if nodata is not None else 'SimpleSource')
+            ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = raster
+            ET.SubElement(source, 'SourceBand').text = str(band)
+            # source properties let GDAL defer opening the tile until it is read
+            ET.SubElement(
+                source, 'SourceProperties',
+                RasterXSize=str(tile_width), RasterYSize=str(tile_height), DataType=data_type,
+                BlockXSize=str(min(block_width, tile_width)), BlockYSize=str(min(block_height, tile_height)))
+            ET.SubElement(
+                source, 'SrcRect',
+                xOff='0', yOff='0', xSize=str(tile_width), ySize=str(tile_height))
+            ET.SubElement(
+                source, 'DstRect',
+                xOff=repr((x0 - minx) / resx), yOff=repr((maxy - y1) / resy),
+                xSize=repr((x1 - x0) / resx), ySize=repr((y1 - y0) / resy))
+
+            if nodata is not None:
+                ET.SubElement(source, 'NODATA').text = repr(float(nodata if src_nodata is None else src_nodata))
+
+    ET.ElementTree(vrt).write(vrt_path)
+
+    print('{} tiles mosaicked in {} ({} x {} pixels)'.format(len(extents), vrt_path, width, height))
+
+@fct.report.instrument
+def ClipRasterByPolygon(
+        raster_path,
+        polygon_path,
+        output_raster_path,
+        block_size: int = 1024,
+        workers: int = 4,
+        compress: str = 'DEFLATE',
+        all_touched: bool = False):
+    """
+    Clip a raster by the polygons of a mask file, block by block.
+
+    The output is cropped to the mask bounding box, like rasterio.mask.mask
+    with crop=True, and the pixels outside the polygons are set to nodata
+    (0 if the raster has no nodata). The mask is rasterized per output block
+    of `block_size` pixels (a multiple of 256), only with the polygons
+    overlapping the block, and the blocks are read and written in a thread
+    pool of `workers` threads, so the raster is never loaded in memory.
+    The output is a tiled and `compress` compressed GeoTIFF.
+    """
     with fiona.open(polygon_path, "r") as poly:
-        feature = shape(poly['geometry'])
+        polygons = [shape(feature['geometry']) for feature in poly]
 
-        with open(raster_path) as src:
-            out_image, out_transform = rasterio.mask.mask(src, feature, crop=True)
-            out_meta = src.meta
+    polygons_index = shapely.STRtree(polygons)
+    block_size = max(256, block_size // 256 * 256)
 
-            out_meta.update({"driver": "GTiff",
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform})
-            
+    with rasterio.open(raster_path) as src:
+        crop_window = rasterio.features.geometry_window(src, polygons)
+        out_transform = src.window_transform(crop_window)
+        width = int(crop_window.width)
+        height = int(crop_window.height)
+        nodata = src.nodata if src.nodata is not None else 0
+
+        out_meta = src.meta.copy()
+        out_meta.update({"driver": "GTiff",
+                "height": height,
+                "width": width,
+                "transform": out_transform,
+                "nodata": nodata,
+                "compress": compress,
+                "tiled": True,
+                "blockxsize": 256,
+                "blockysize": 256,
+                "BIGTIFF": 'IF_SAFER'})
+
+    fct.report.count(width * height, 'pixels')
+
+    lock = threading.Lock()
+    local = threading.local()
+    sources = []
+
+    def clip_block(dest, window):
+        """ Read, mask and write an output block
+        """
+        # one source dataset per thread, rasterio datasets are not thread safe
+        if not hasattr(local, 'src'):
+            local.src = rasterio.open(raster_path)
+            with lock:
+                sources.append(local.src)
+
+        block_transform = rasterio.windows.transform(window, out_transform)
+        block_bounds = rasterio.windows.bounds(window, out_transform)
+        block_polygons = [polygons[i] for i in polygons_index.query(box(*block_bounds), predicate='intersects')]
+
+        src_window = rasterio.windows.Window(
+            crop_window.col_off + window.col_off, crop_window.row_off + window.row_off,
+            window.width, window.height)
+        values = local.src.read(window=src_window, boundless=True, fill_value=nodata)
+
+        if block_polygons:
+            outside = rasterio.features.geometry_mask(
+                block_polygons, out_shape=(window.height, window.width),
+                transform=block_transform, all_touched=all_touched)
+            values[:, outside] = nodata
+        else:
+            values[:] = nodata
+
+        with lock:
+            dest.write(values, window=window)
+
+    windows = [
+        rasterio.windows.Window(col, row, min(block_size, width - col), min(block_size, height - row))
+        for row in range(0, height, block_size)
+        for col in range(0, width, block_size)
+    ]
+
+    try:
         with rasterio.open(output_raster_path, "w", **out_meta) as dest:
-            dest.write(out_image)
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                # raise the first block error
+                for _ in executor.map(lambda window: clip_block(dest, window), windows):
+                    pass
+    finally:
+        for src in sources:
+            src.close()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+-------------------------------------------------------------------------------
+"This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import cProfile
+import datetime
+import functools
+import threading
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not reported
+    resource = None
+
+# records of the measured calls, in completion order
+records = []
+records_lock = threading.Lock()
+
+# measure running in the current thread
+local = threading.local()
+
+REPORT_FIELDS = [
+    'name', 'status', 'start', 'duration', 'cpu_time', 'max_rss',
+    'read_bytes', 'write_bytes', 'items', 'unit', 'items_per_second', 'commands', 'tasks'
+]
+
+# interval between two samples of the resident memory, in seconds
+RSS_SAMPLING_INTERVAL = 0.05
+
+def read_process_io():
+    """
+    Bytes read and written by the process (Linux only, 0 elsewhere).
+    """
+    counters = dict()
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        pass
+
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+def read_max_rss():
+    """
+    Lifetime peak resident memory of the process in bytes, None if not available.
+    """
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def read_rss():
+    """
+    Current resident memory of the process in bytes (Linux only, None elsewhere).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemorySampler:
+    """
+    Thread sampling the resident memory of the process until stopped, to find
+    the peak memory during a measure. The lifetime peak (ru_maxrss) is used
+    instead when it increased during the measure, since it is then exact.
+    """
+
+    def __init__(self, interval=RSS_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start_max_rss = read_max_rss()
+        self.max_rss = read_rss()
+        self.thread = None
+
+        if self.max_rss is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.max_rss = max(self.max_rss, read_rss() or 0)
+
+    def stop(self):
+        """
+        Stop sampling and return the peak memory in bytes, None if not available.
+        """
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.max_rss = max(self.max_rss, read_rss() or 0)
+
+        max_rss = read_max_rss()
+        if max_rss is not None and self.start_max_rss is not None and max_rss > self.start_max_rss:
+            return max_rss
+
+        return self.max_rss
+
+class Measure:
+    """
+    Context manager recording the duration, CPU time, peak memory, bytes
+    read and written and items processed of a workflow stage or a tool call.
+
+    CPU time and I/O are the differences of the process counters between the
+    start and the end of the measure, and the peak memory is sampled during
+    the measure (see MemorySampler). The usage of the commands run with
+    fct.utils.process_with_stdout, and of the process pool tasks run with
+    run_task, is added to the measure: the peak memory adds the peak of the
+    process, of the largest command and of each pool worker, an upper bound
+    when these peaks do not coincide. The process counters overlap when
+    stages run concurrently.
+
+    Measures nested in the same thread are merged in the outermost one. With
+    `profile_path`, the calling thread is profiled with cProfile and the stats
+    are dumped to this file. Without `keep`, the measure is not added to the
+    records, and its usage is only available in the `usage` attribute.
+    """
+
+    def __init__(self, name, profile_path=None, keep=True):
+        self.name = name
+        self.profile_path = profile_path
+        self.keep = keep
+        self.outer = None
+        self.items = 0
+        self.unit = None
+        self.commands = []
+        self.tasks = []
+        self.usage = None
+
+    def __enter__(self):
+        self.outer = getattr(local, 'measure', None)
+
+        if self.outer is not None:
+            return self.outer
+
+        local.measure = self
+        self.start = datetime.datetime.now().isoformat(timespec='seconds')
+        self.start_time = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_io = read_process_io()
+        self.memory = MemorySampler()
+
+        if self.profile_path is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outer is not None:
+            return False
+
+        if self.profile_path is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+
+        local.measure = None
+
+        duration = time.perf_counter() - self.start_time
+        read_bytes, write_bytes = read_process_io()
+        usages = self.commands + self.tasks
+
+        # the workers run their tasks one after the other
+        worker_max_rss = dict()
+        for task in self.tasks:
+            if task['max_rss'] is not None:
+                worker_max_rss[task['pid']] = max(worker_max_rss.get(task['pid'], 0), task['max_rss'])
+
+        max_rss = [
+            self.memory.stop(),
+            max((command['max_rss'] for command in self.commands if command['max_rss'] is not None), default=None)
+        ] + list(worker_max_rss.values())
+        max_rss = [value for value in max_rss if value is not None]
+
+        items = self.items + sum(task['items'] for task in self.tasks)
+        unit = self.unit or next((task['unit'] for task in self.tasks if task['unit']), None)
+
+        self.usage = dict(
+            name=self.name,
+            status='failed' if exc_type is not None else 'done',
+            start=self.start,
+            duration=duration,
+            cpu_time=time.process_time() - self.start_cpu + sum(usage['cpu_time'] for usage in usages),
+            max_rss=sum(max_rss) if max_rss else None,
+            read_bytes=read_bytes - self.start_io[0] + sum(usage['read_bytes'] for usage in usages),
+            write_bytes=write_bytes - self.start_io[1] + sum(usage['write_bytes'] for usage in usages),
+            items=items,
+            unit=unit,
+            items_per_second=items / duration if items and duration > 0 else None,
+            commands=len(self.commands) + sum(task['commands'] for task in self.tasks),
+            tasks=len(self.tasks))
+
+        if self.keep:
+            with records_lock:
+                records.append(self.usage)
+
+        return False
+
+def instrument(func):
+    """
+    Decorator measuring each call of a tool, see Measure.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with Measure(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def count(items, unit):
+    """
+    Add processed items (tiles, features, pixels ...) to the measure running in the current thread.
+    """
+    measure = getattr(local, 'measure', None)
+
+    if measure is not None:
+        measure.items += items
+        measure.unit = measure.unit or unit
+
+def add_command(usage):
+    """
+    Add the resource usage of an external command to the measure running in the current thread.
+    """
+    measure = getattr(local, 'measure', None)
+
+    if measure is not None:
+        measure.commands.append(usage)
+
+def run_task(func, *args):
+    """
+    Run `func(*args)` in a process pool worker, and return its result with its
+    resource usage, to add to the measure of the calling stage with add_task:
+    the pool workers are not children of the calling process, their usage is
+    not in its counters.
+
+    `func` must be defined at module level, see fct.utils.process_pool.
+    """
+    # a forked worker inherits the measure running in the calling thread
+    local.measure = None
+    measure = Measure(func.__name__, keep=False)
+
+    with measure:
+        result = func(*args)
+
+    usage = dict(measure.usage, pid=os.getpid())
+
+    return result, usage
+
+def add_task(usage):
+    """
+    Add the resource usage of a process pool task, returned by run_task, to the measure running in the current thread.
+    """
+    measure = getattr(local, 'measure', None)
+
+    if measure is not None:
+        measure.tasks.append(usage)
+
+def reset():
+    """
+    Remove the measure records, e.g. before running another workflow in the same process.
+    """
+    with records_lock:
+        del records[:]
+
+def write_report(report_path):
+    """
+    Write the measure records as CSV if `report_path` ends with .csv, as JSON otherwise.
+    """
+    with records_lock:
+        report = list(records)
+
+    if report_path.endswith('.csv'):
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(report)
+    else:
+        with open(report_path, 'w') as f:
+            json.dump(dict(
+                host=socket.gethostname(),
+                cpu_count=os.cpu_count(),
+                created=datetime.datetime.now().isoformat(timespec='seconds'),
+                records=report), f, indent=2)
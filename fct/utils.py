@@ -18,23 +18,133 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 -------------------------------------------------------------------------------
 """
 
+import os
 import sys
+import time
+import signal
+import threading
 import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fct.report
+
+# processes started by process_with_stdout and still running
+running_processes = set()
+running_processes_lock = threading.Lock()
+
+def process_pool(workers):
+    """
+    Process pool of `workers` processes started by a fork server (spawned on
+    Windows), not forked from the calling process: the tools create their pools
+    from workflow stage threads, and a process forked while another thread
+    holds a lock (GDAL, logging ...) can hang forever.
+
+    The worker functions must be defined at module level.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+    return ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context(method))
+
+def process_with_stdout(command, check=True):
+    """
+    Run a shell command, printing its stdout and stderr in real time.
+
+    Both pipes are drained at the same time by two threads, so a command
+    writing a lot on stderr can not block. The command runs in its own process
+    group, so that terminate_running_processes stops it with its children.
+
+    Parameters:
+    - command (str): Shell command.
+    - check (bool): Optional. Raise subprocess.CalledProcessError on a non-zero exit code. Default is True.
+
+    Returns:
+    - dict: command, returncode, wall_time (s), cpu_time (s), max_rss (bytes, None if not available),
+      read_bytes and write_bytes.
+    """
+    start_time = time.perf_counter()
 
-def process_with_stdout(command):
     # define process
-    process = subprocess.Popen(command, shell=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, universal_newlines=True)
-
-    # Read and print the output in real-time
-    for line in iter(process.stdout.readline, ''):
-        sys.stdout.write(line)
-        sys.stdout.flush()
-    # Wait for the process to finish
-    process.wait()
+    process = subprocess.Popen(
+        command, shell=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        bufsize=1, start_new_session=(os.name == 'posix'))
+
+    with running_processes_lock:
+        running_processes.add(process)
+
+    def drain(pipe, output):
+        """ Read and print the output in real-time
+        """
+        for line in iter(pipe.readline, ''):
+            output.write(line)
+            output.flush()
+        pipe.close()
+
+    threads = [
+        threading.Thread(target=drain, args=(process.stdout, sys.stdout), daemon=True),
+        threading.Thread(target=drain, args=(process.stderr, sys.stderr), daemon=True)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Wait for the process to finish, with its resource usage when available
+    try:
+        if hasattr(os, 'wait4'):
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+            cpu_time = rusage.ru_utime + rusage.ru_stime
+            # block operations are counted in 512 bytes units
+            read_bytes = rusage.ru_inblock * 512
+            write_bytes = rusage.ru_oublock * 512
+        else:
+            process.wait()
+            max_rss = None
+            cpu_time = 0
+            read_bytes = 0
+            write_bytes = 0
+    finally:
+        with running_processes_lock:
+            running_processes.discard(process)
+
+    for thread in threads:
+        thread.join()
+
+    wall_time = time.perf_counter() - start_time
+
     # Print the exit code
-    print("Process finished with exit code:", process.returncode)
+    print("Process finished with exit code: {} in {:.1f} s, peak memory {}".format(
+        process.returncode, wall_time,
+        '{:.0f} MB'.format(max_rss / 2**20) if max_rss is not None else 'unknown'))
+
+    usage = dict(
+        command=command,
+        returncode=process.returncode,
+        wall_time=wall_time,
+        cpu_time=cpu_time,
+        max_rss=max_rss,
+        read_bytes=read_bytes,
+        write_bytes=write_bytes)
 
+    fct.report.add_command(usage)
 
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
+    return usage
 
+def terminate_running_processes():
+    """
+    Terminate the commands still running, with their children.
+    """
+    with running_processes_lock:
+        processes = list(running_processes)
 
+    for process in processes:
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGTERM)
+            else:
+                process.terminate()
+        except (ProcessLookupError, PermissionError):
+            pass
@@ -19,153 +19,545 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+import mmap
+import heapq
+import shutil
+import struct
+import pathlib
+import tempfile
+import sqlite3
 import click
 import fiona
 import fiona.crs
-from shapely.geometry import shape, box
-from shapely.ops import unary_union, nearest_points
+import shapely
+from shapely.geometry import shape, mapping
+from shapely.ops import unary_union
 from rtree import index
-from shapely.geometry import LineString, MultiLineString, mapping, Point, MultiPoint
 import numpy as np
+import fct.utils
+import fct.report
+import fct.network_graph
 
-def ExtractBylocation(input_file, mask_file, output_file, method):
-    selected_features = []
+def connect_read_only(path):
+    """
+    Open a SQLite database (e.g. a GeoPackage) read-only, through a file URI
+    escaping the characters of the path that are special in URIs.
+    """
+    return sqlite3.connect(pathlib.Path(path).resolve().as_uri() + '?mode=ro', uri=True)
 
-    # Create spatial index for input layer
-    input_index = index.Index()
-    with fiona.open(input_file, 'r') as input_layer:
-        for idx, input_feature in input_layer.items():
-            in_feat = shape(input_feature['geometry'])
-            input_index.insert(idx, in_feat.bounds)
+def has_native_spatial_index(path, layer_name):
+    """
+    Check if a layer is a GeoPackage table with its own R*Tree spatial index,
+    kept up to date by the GeoPackage triggers.
+    """
+    if not path.lower().endswith('.gpkg'):
+        return False
+
+    try:
+        connection = connect_read_only(path)
+        try:
+            rows = connection.execute(
+                "SELECT 1 FROM gpkg_extensions WHERE lower(table_name) = lower(?) AND extension_name = 'gpkg_rtree_index'",
+                (layer_name,)).fetchall()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+
+    return len(rows) > 0
+
+def shapefile_bounds(path):
+    """
+    Read the bounds of the shapes of a shapefile from the record headers of
+    the .shp file, found with the .shx offsets, without decoding the shapes.
+
+    Parameters:
+    - path (str): Path to the .shp file.
+
+    Returns:
+    - iterator: (fid, (minx, miny, maxx, maxy)) for each non null shape.
+    """
+    shx_path = os.path.splitext(path)[0] + '.shx'
+
+    with open(shx_path, 'rb') as f:
+        # 100 bytes header, then the offset and length of each record in 16 bits words, big endian
+        offsets = np.frombuffer(f.read(), dtype='>i4', offset=100).reshape(-1, 2)[:, 0].astype(np.int64) * 2
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as shp:
+            for fid, offset in enumerate(offsets.tolist()):
+                # 8 bytes record header, then the shape type, little endian
+                shape_type, = struct.unpack_from('<i', shp, offset + 8)
+
+                if shape_type == 0:
+                    continue
+
+                # points have their coordinates, the other shapes their bounding box first
+                if shape_type in (1, 11, 21):
+                    x, y = struct.unpack_from('<2d', shp, offset + 12)
+                    yield fid, (x, y, x, y)
+                else:
+                    yield fid, struct.unpack_from('<4d', shp, offset + 12)
+
+def geopackage_bounds(path, layer_name, batch_size=65536):
+    """
+    Read the bounds of the geometries of a GeoPackage table straight from the
+    geometry blobs with SQLite, decoded in batches by shapely, without OGR.
+
+    Parameters:
+    - path (str): Path to the GeoPackage file.
+    - layer_name (str): Name of the table.
+    - batch_size (int): Optional. Number of geometries decoded together. Default is 65536.
+
+    Returns:
+    - iterator: (fid, (minx, miny, maxx, maxy)) for each non empty geometry.
+    """
+    # envelope size in bytes for each envelope indicator of the blob header flags
+    envelope_sizes = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+    def quote(name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    connection = connect_read_only(path)
+
+    try:
+        geometry_column, = connection.execute(
+            "SELECT column_name FROM gpkg_geometry_columns WHERE lower(table_name) = lower(?)",
+            (layer_name,)).fetchone()
+        fid_column = next(
+            row[1] for row in connection.execute('PRAGMA table_info({})'.format(quote(layer_name)))
+            if row[5] == 1)
+
+        cursor = connection.execute('SELECT {}, {} FROM {} WHERE {} IS NOT NULL'.format(
+            quote(fid_column), quote(geometry_column), quote(layer_name), quote(geometry_column)))
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            # 8 bytes header ('GP', version, flags, srs id) and the envelope before the WKB geometry
+            wkb = [bytes(blob[8 + envelope_sizes[(blob[3] >> 1) & 7]:]) for _, blob in rows]
+            bounds = shapely.bounds(shapely.from_wkb(wkb))
+
+            for (fid, _), geometry_bounds in zip(rows, bounds.tolist()):
+                # empty geometries have NaN bounds
+                if geometry_bounds[0] == geometry_bounds[0]:
+                    yield fid, tuple(geometry_bounds)
+    finally:
+        connection.close()
+
+def layer_bounds(layer, path):
+    """
+    Read the bounds of the features of a layer, without decoding the
+    geometries with OGR for shapefiles and GeoPackage tables.
+
+    Returns:
+    - iterator: (fid, (minx, miny, maxx, maxy)) for each feature with a geometry.
+    """
+    if layer.driver == 'ESRI Shapefile' and path.lower().endswith('.shp'):
+        return shapefile_bounds(path)
+
+    if layer.driver == 'GPKG':
+        return geopackage_bounds(path, layer.name)
+
+    return (
+        (fid, shape(feature['geometry']).bounds)
+        for fid, feature in layer.items()
+        if feature['geometry'] is not None
+    )
+
+def file_fingerprint(path):
+    """
+    Fingerprint of a file, from its size and modification time, to name the caches derived from it.
+    """
+    stat = os.stat(path)
+    return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+def spatial_index(path):
+    """
+    Open the file-backed rtree index of the features bounds of a layer, saved
+    next to it in the <path>.sidx directory. The index is bulk-loaded on first
+    use in a subdirectory named after the size and the modification time of
+    the layer file, so that it is rebuilt when the layer file changes.
+    The index ids are the feature ids.
+
+    The index is built in a temporary directory published with a single
+    rename: concurrent runs either find the complete index or build their
+    own, and the first rename wins.
+
+    Parameters:
+    - path (str): Path to the layer file.
+
+    Returns:
+    - rtree.index.Index: The index, to close after use.
+    """
+    index_dir = path + '.sidx'
+    fingerprint = file_fingerprint(path)
+    basename = os.path.join(index_dir, fingerprint, 'index')
+
+    if os.path.exists(basename + '.idx'):
+        return index.Index(basename)
+
+    click.secho('Build spatial index of %s' % path, fg='yellow')
+
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='tmp.', dir=index_dir)
+
+    try:
+        with fiona.open(path) as layer:
+            properties = index.Property(overwrite=True)
+            items = [(fid, bounds, None) for fid, bounds in layer_bounds(layer, path)]
+            tmp_basename = os.path.join(tmp_dir, 'index')
+            # the bulk loader does not accept an empty layer
+            if items:
+                index.Index(tmp_basename, iter(items), properties=properties).close()
+            else:
+                index.Index(tmp_basename, properties=properties).close()
+
+        try:
+            os.rename(tmp_dir, os.path.dirname(basename))
+        except OSError:
+            # another run published the same index first
+            if not os.path.exists(basename + '.idx'):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # remove the indexes of the previous versions of the layer file
+    for name in os.listdir(index_dir):
+        if name != fingerprint and not name.startswith('tmp.'):
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+    return index.Index(basename)
+
+def ensure_spatial_index(path):
+    """
+    Build the file-backed rtree index of a layer (see spatial_index) if it is
+    missing or out of date, unless the layer has its own GeoPackage R*Tree.
+    """
+    with fiona.open(path) as layer:
+        if has_native_spatial_index(path, layer.name):
+            return
+
+    spatial_index(path).close()
+
+def features_in_bounds(layer, path, bounds):
+    """
+    Read the features of a layer whose extent intersects `bounds`, without reading the others.
+
+    GeoPackage tables with their own R*Tree index are read with an OGR spatial
+    filter, in the index order. The other layers are read by feature id, for
+    the candidates found in their file-backed rtree index (see spatial_index),
+    in the feature id order. These candidates are the features whose bounds
+    intersect `bounds`, their geometries may not.
+
+    Parameters:
+    - layer (fiona.Collection): The layer opened for reading.
+    - path (str): Path to the layer file.
+    - bounds (tuple): (minx, miny, maxx, maxy) extent.
+
+    Returns:
+    - iterator: The features.
+    """
+    if has_native_spatial_index(path, layer.name):
+        return layer.filter(bbox=bounds)
+
+    layer_index = spatial_index(path)
+    try:
+        fids = sorted(layer_index.intersection(bounds))
+    finally:
+        layer_index.close()
 
-    # Create spatial index for mask layer
-    mask_index = index.Index()
+    return (layer[fid] for fid in fids)
+
+def load_mask_index(mask_file, method='intersects'):
+    """
+    Load and prepare the mask geometries, and bulk-load them in a STRtree.
+    Multipart masks are exploded for the 'intersects' method, when the predicate
+    holds for the whole geometry as soon as it holds for one part.
+
+    Parameters:
+    - mask_file (str): Path to the mask features file.
+    - method (str): Optional. Spatial predicate, see ExtractBylocation. Default is 'intersects'.
+
+    Returns:
+    - numpy.ndarray: The prepared mask geometries.
+    - shapely.STRtree: The mask geometries index.
+    """
     with fiona.open(mask_file, 'r') as mask_layer:
-        for idx, mask_feature in mask_layer.items():
-            mask_feat = shape(mask_feature['geometry'])
-            mask_index.insert(idx, mask_feat.bounds)
-    
-    with fiona.open(mask_file, 'r') as mask_layer, fiona.open(input_file, 'r') as input_layer:
+        mask_geometries = [shape(mask_feature['geometry']) for mask_feature in mask_layer]
+
+    if method == 'intersects':
+        mask_geometries = shapely.get_parts(mask_geometries)
+    else:
+        mask_geometries = np.array(mask_geometries, dtype=object)
+
+    shapely.prepare(mask_geometries)
+
+    return mask_geometries, shapely.STRtree(mask_geometries)
+
+@fct.report.instrument
+def ExtractBylocation(input_file, mask_file, output_file, method, batch_size=10000):
+    """
+    Extract the input features matching a spatial predicate with the mask features.
+
+    The mask geometries are prepared and bulk-loaded in a STRtree once. The input
+    features in the mask extent are read in a single pass, with the layer spatial
+    index (see features_in_bounds), by batches of features tested together with a vectorized predicate
+    query, and the matching features of each batch are written as they are selected,
+    in the spatial filter order (see features_in_bounds).
+    Each input feature is written at most once, whatever the number of mask features
+    it matches.
+
+    Parameters:
+    - input_file (str): Path to the input features file.
+    - mask_file (str): Path to the mask features file.
+    - output_file (str): Path to the output file, with the input layer schema.
+    - method (str): Spatial predicate, from the mask point of view:
+        - 'intersects': the mask intersects the input feature.
+        - 'contains': the mask contains the input feature.
+        - 'within': the mask is within the input feature.
+    - batch_size (int): Optional. Number of input features tested together. Default is 10000.
+
+    Returns:
+    - None
+
+    Raises:
+    - ValueError: If the method is not supported.
+    """
+    # STRtree predicates are evaluated as predicate(input, mask)
+    predicates = {
+        'intersects': 'intersects',
+        'contains': 'within',
+        'within': 'contains'
+    }
+
+    if method not in predicates:
+        raise ValueError('Unsupported method %s, expected one of %s' % (method, ', '.join(predicates)))
+
+    predicate = predicates[method]
+
+    mask_geometries, mask_index = load_mask_index(mask_file, method)
+    mask_bounds = tuple(shapely.total_bounds(mask_geometries).tolist())
+
+    def select(batch):
+        fct.report.count(len(batch), 'features')
+        geometries = [shape(feature['geometry']) for feature in batch]
+        input_idx, _ = mask_index.query(geometries, predicate=predicate)
+        # unique also keeps the input order
+        return [batch[i] for i in np.unique(input_idx)]
+
+    with fiona.open(input_file, 'r') as input_layer:
         options = dict(
                 driver=input_layer.driver,
                 schema=input_layer.schema.copy(),
                 crs=input_layer.crs)
 
-        for mask_feature in mask_layer:
-            # print(polygon_feature)
-            mask = shape(mask_feature['geometry'])
-
-            # Get potential linestrings within the bounding box of the polygon
-            potential_input = list(input_index.intersection(mask.bounds))
-
-            for input_id  in potential_input:
-                input_feature = input_layer[input_id]
-                # print(linestring_feature)
-                input = shape(input_feature['geometry'])
-
-                if method == 'intersects':
-                    if mask.intersects(input):
-                        selected_features.append(input_feature)
-                if method == 'contains':
-                    if mask.contains(input):
-                        selected_features.append(input_feature)
-    # Create a new GeoPackage file and write the selected features to it
-    with fiona.open(output_file, 'w', **options) as output_layer:
-        for feature in selected_features:
-            output_layer.write(feature)
+        # Create a new GeoPackage file with the selected features
+        with fiona.open(output_file, 'w', **options) as output_layer:
 
-def StrahlerOrder(hydro_network, output_network, overwrite=True):
+            # only read the features in the mask extent, with the layer spatial index,
+            # and write the matching features batch by batch
+            batch = []
+
+            for input_feature in features_in_bounds(input_layer, input_file, mask_bounds):
+                batch.append(input_feature)
+
+                if len(batch) == batch_size:
+                    output_layer.writerecords(select(batch))
+                    batch = []
+
+            if batch:
+                output_layer.writerecords(select(batch))
+
+# mask indexes loaded by the clip worker processes, by mask file
+clip_masks = dict()
+
+def clip_network_tile(network, mask_file, tile, grid, mode='select'):
     """
-    Calculate Strahler stream order
+    Select or cut the network lines of a grid tile with the mask, in a worker process.
+
+    The lines are read with the network spatial index on the tile extent. A line
+    overlapping several tiles is only handled by the tile containing its first
+    point inside the grid, so that each line is output once.
+
     Parameters:
-    - params (object): An object containing the parameters.
-        - hydro_network (str): The filename of the hydro network.
-        - hydrography_strahler (str): The filename for hydro network with Strahler order.
-    - overwrite (bool): Optional. Specifies whether to overwrite existing tiled buffer files. Default is True.
-    - source code from https://here.isnew.info/strahler-stream-order-in-python.html
+    - network (str): Path to the network file.
+    - mask_file (str): Path to the mask features file.
+    - tile (tuple): Column and row of the tile.
+    - grid (tuple): Grid origin x and y, tile size, number of columns and rows.
+    - mode (str): Optional. 'select' or 'cut', see ClipNetworkByMask. Default is 'select'.
 
     Returns:
-    - None
+    - list: (feature id, properties, geometry) of the output lines, in feature id order.
+    """
+    if mask_file not in clip_masks:
+        clip_masks[mask_file] = load_mask_index(mask_file)
+
+    mask_geometries, mask_index = clip_masks[mask_file]
+    x0, y0, tile_size, columns, rows = grid
+    col, row = tile
+    bbox = (x0 + col * tile_size, y0 + row * tile_size, x0 + (col + 1) * tile_size, y0 + (row + 1) * tile_size)
+    extent = (x0, y0, x0 + columns * tile_size, y0 + rows * tile_size)
 
+    features = list()
+    geometries = list()
+
+    with fiona.open(network) as fs:
+        for feature in features_in_bounds(fs, network, bbox):
+            geometry = shape(feature['geometry'])
+            x, y = feature['geometry']['coordinates'][0][:2]
+
+            if not (x0 <= x <= extent[2] and y0 <= y <= extent[3]):
+                # first point of the line inside the grid
+                inside = shapely.get_parts(shapely.clip_by_rect(geometry, *extent))
+                if len(inside) == 0:
+                    continue
+                x, y = inside[0].coords[0][:2]
+
+            owner_col = min(int((x - x0) // tile_size), columns - 1)
+            owner_row = min(int((y - y0) // tile_size), rows - 1)
+
+            if (owner_col, owner_row) == (col, row):
+                features.append(feature)
+                geometries.append(geometry)
+
+    if not geometries:
+        return []
+
+    input_idx, mask_idx = mask_index.query(geometries, predicate='intersects')
+    output = list()
+
+    if mode == 'select':
+        for i in np.unique(input_idx):
+            output.append((int(features[i].id), dict(features[i]['properties']), features[i]['geometry']))
+
+    else:
+        # cut each line with the mask parts it intersects, as single part lines
+        for i in np.unique(input_idx):
+            parts = mask_geometries[mask_idx[input_idx == i]]
+            clipped = shapely.line_merge(geometries[i].intersection(unary_union(parts)))
+
+            for part in shapely.get_parts(clipped):
+                if part.geom_type == 'LineString' and not part.is_empty:
+                    output.append((int(features[i].id), dict(features[i]['properties']), mapping(part)))
+
+    output.sort(key=lambda item: item[0])
+
+    return output
+
+@fct.report.instrument
+def ClipNetworkByMask(network, mask_file, output_network, mode='select', tile_size=20000, workers=4):
     """
-    click.secho('Compute Strahler order', fg='yellow')
-    # file path definition
-    # hydro_network = params.hydro_network.filename(tileset=tileset)
-    # hydrography_strahler = params.hydrography_strahler.filename(tileset=tileset)
+    Clip the hydrologic network to the mask.
 
-    # check overwrite
-    if os.path.exists(output_network) and not overwrite:
-        click.secho('Output already exists: %s' % output_network, fg='yellow')
-        return
+    The mask extent is partitioned in a grid of square tiles, processed in
+    parallel by a process pool: each worker reads the network lines of its
+    tile only and tests them with the mask STRtree, built once per process
+    like in ExtractBylocation. The results of the tiles are merged in the
+    network feature order.
 
-    # function to find head line in network (top upstream)
-    def find_head_lines(lines):
-        head_idx = []
+    Parameters:
+    - network (str): Path to the hydrologic network file.
+    - mask_file (str): Path to the mask features file.
+    - output_network (str): Path to the clipped network file, with the network layer schema.
+    - mode (str): Optional. How to clip the lines intersecting the mask. Default is 'select'.
+        - 'select': keep the whole lines.
+        - 'cut': cut the lines at the mask boundary, a line crossing the
+          boundary several times gives several lines with the same attributes.
+    - tile_size (float): Optional. Size of the grid tiles, in the network CRS units. Default is 20000.
+    - workers (int): Optional. Number of worker processes. Default is 4.
 
-        num_lines = len(lines)
-        for i in range(num_lines):
-            line = lines[i]
-            first_point = line[0]
+    Returns:
+    - None
 
-            has_upstream = False
+    Raises:
+    - ValueError: If the mode is not supported.
+    """
+    if mode not in ('select', 'cut'):
+        raise ValueError('Unsupported mode %s, expected select or cut' % mode)
 
-            for j in range(num_lines):
-                if j == i:
-                    continue
-                line = lines[j]
-                last_point = line[len(line)-1]
+    with fiona.open(mask_file) as mask_layer:
+        minx, miny, maxx, maxy = mask_layer.bounds
 
-                if first_point == last_point:
-                    has_upstream = True
+    columns = max(1, int(np.ceil((maxx - minx) / tile_size)))
+    rows = max(1, int(np.ceil((maxy - miny) / tile_size)))
+    grid = (minx, miny, tile_size, columns, rows)
+    tiles = [(col, row) for row in range(rows) for col in range(columns)]
 
-            if not has_upstream:
-                head_idx.append(i)
+    click.secho('Clip network on %d tiles' % len(tiles), fg='yellow')
 
-        return head_idx
+    # build the network spatial index once, before the workers open it
+    ensure_spatial_index(network)
 
-    # function to find next line downstream
-    def find_next_line(curr_idx, lines):
-        num_lines = len(lines)
+    with fct.utils.process_pool(workers) as executor:
+        futures = [
+            executor.submit(fct.report.run_task, clip_network_tile, network, mask_file, tile, grid, mode)
+            for tile in tiles
+        ]
+        results = []
+        for future in futures:
+            result, usage = future.result()
+            fct.report.add_task(usage)
+            results.append(result)
 
-        line = lines[curr_idx]
-        last_point = line[len(line)-1]
+    # the clipped reaches, not the whole input network
+    fct.report.count(sum(len(result) for result in results), 'features')
 
-        next_idx = None
+    with fiona.open(network) as fs:
+        options = dict(driver=fs.driver, schema=fs.schema.copy(), crs=fs.crs)
 
-        for i in range(num_lines):
-            if i == curr_idx:
-                continue
-            line = lines[i]
-            first_point = line[0]
+    with fiona.open(output_network, 'w', **options) as dst:
+        dst.writerecords(
+            {
+                'type': 'Feature',
+                'properties': properties,
+                'geometry': geometry
+            }
+            for _, properties, geometry in heapq.merge(*results, key=lambda item: item[0])
+        )
 
-            if last_point == first_point:
-                next_idx = i
-                break
+    click.secho('%d lines clipped from %s' % (sum(len(result) for result in results), network), fg='green')
+
+@fct.report.instrument
+def StrahlerOrder(hydro_network, output_network, overwrite=True):
+    """
+    Calculate Strahler stream order
 
-        return next_idx
+    Orders are computed on the compact graph of the network (see
+    fct.network_graph.NetworkGraph.strahler_order), in a single topological
+    pass, and the output is written in a second read of the network: the
+    features are never all kept in memory.
 
-    # function to find sibling line (confluence line)
-    def find_sibling_line(curr_idx, lines):
-        num_lines = len(lines)
+    Parameters:
+    - params (object): An object containing the parameters.
+        - hydro_network (str): The filename of the hydro network.
+        - hydrography_strahler (str): The filename for hydro network with Strahler order.
+    - overwrite (bool): Optional. Specifies whether to overwrite existing tiled buffer files. Default is True.
+    - source code from https://here.isnew.info/strahler-stream-order-in-python.html
 
-        line = lines[curr_idx]
-        last_point = line[len(line)-1]
+    Returns:
+    - None
 
-        sibling_idx = None
+    """
+    click.secho('Compute Strahler order', fg='yellow')
+    # file path definition
+    # hydro_network = params.hydro_network.filename(tileset=tileset)
+    # hydrography_strahler = params.hydrography_strahler.filename(tileset=tileset)
 
-        for i in range(num_lines):
-            if i == curr_idx:
-                continue
-            line = lines[i]
-            last_point2 = line[len(line)-1]
+    # check overwrite
+    if os.path.exists(output_network) and not overwrite:
+        click.secho('Output already exists: %s' % output_network, fg='yellow')
+        return
 
-            if last_point == last_point2:
-                sibling_idx = i
-                break
+    # compute all orders in one pass over the network graph
+    graph = fct.network_graph.NetworkGraph.from_network(hydro_network)
+    orders = graph.strahler_order()
 
-        return sibling_idx
+    fct.report.count(len(graph), 'features')
 
-    # read reference network
+    # read reference network again, in the graph order
     with fiona.open(hydro_network, 'r') as source:
 
         schema = source.schema.copy()
@@ -178,72 +570,50 @@ def StrahlerOrder(hydro_network, output_network, overwrite=True):
         # Add the new field to the schema
         schema['properties'][strahler_field_name] = strahler_field_type
 
-        lines = []
-        source_copy = []
-
-        # copy feature with strahler field in source_copy and the the line coordinates in lines
-        for feature in source:
-                # Create a new feature with the new field
-                new_properties = feature['properties']
-                new_properties[strahler_field_name] = 0  # Set the strahler field value to 0
-                geom = shape(feature['geometry'])
-                # copy line coordinates to find head line
-                line = geom.coords
-                lines.append(line)
-                # copy features in new list to update the data before write all
-                source_copy.append(feature)
-
-        # save head lines index
-        head_idx = find_head_lines(lines)
-
-        with click.progressbar(head_idx) as processing:
-            for idx in processing:
-                curr_idx = idx
-                curr_ord = 1
-                # head lines order = 1
-                source_copy[curr_idx]['properties'][strahler_field_name] = curr_ord
-                # go downstream from each head lines
-                while True:
-                    # find next line downstream
-                    next_idx = find_next_line(curr_idx, lines)
-                    # stop iteration if no next line
-                    if next_idx is None:
-                        break
-                    # copy next line feature and order
-                    next_feat = source_copy[next_idx]
-                    next_ord = next_feat['properties'][strahler_field_name]
-                    # find sibling line
-                    sibl_idx = find_sibling_line(curr_idx, lines)
-                    # if confluence
-                    if sibl_idx is not None:
-                        sibl_feat = source_copy[sibl_idx]
-                        sibl_ord = sibl_feat['properties'][strahler_field_name]
-                        # check if confluence, and if same strahler order add +1 to order
-                        if sibl_ord > curr_ord:
-                            break
-                        elif sibl_ord < curr_ord:
-                            if next_ord == curr_ord:
-                                break
-                        else:
-                            curr_ord += 1
-                    # update order in next feature
-                    source_copy[next_idx]['properties'][strahler_field_name] = curr_ord
-                    # go further downstream
-                    curr_idx = next_idx
-
-                # write final features from updated features copy
-                with fiona.open(output_network, 'w', driver=driver, crs=crs, schema=schema) as modif:
-                    for feature in source_copy:
-                        if feature['properties'][strahler_field_name] > 0:
-                            modified_feature = {
-                                    'type': 'Feature',
-                                    'properties': feature['properties'],
-                                    'geometry': feature['geometry'],
-                                }
-
-                            modif.write(modified_feature)
-
-def CreateSources(hydro_network, output_sources, overwrite=True):
+        # write final features once, lines never reached from a head line are dropped
+        with fiona.open(output_network, 'w', driver=driver, crs=crs, schema=schema) as modif:
+            with click.progressbar(zip(source, orders.tolist()), length=len(orders)) as processing:
+                modif.writerecords(
+                    {
+                        'type': 'Feature',
+                        'properties': {**feature['properties'], strahler_field_name: order},
+                        'geometry': feature['geometry'],
+                    }
+                    for feature, order in processing
+                    if order > 0
+                )
+
+def compute_strahler_orders(lines):
+    """
+    Compute Strahler stream order for a list of oriented lines.
+
+    Lines are linked by exact endpoint matching: a line flows into every line
+    starting at its last point. The orders are propagated downstream on the
+    network graph in a single topological pass (see
+    fct.network_graph.NetworkGraph.strahler_order), so the cost is linear in
+    the number of lines. At a confluence, the order is the maximum
+    upstream order, incremented if at least two tributaries share that maximum
+    (confluences with more than two tributaries are supported).
+
+    Parameters:
+    - lines (list): (first_point, last_point) tuple for each line.
+
+    Returns:
+    - list: Strahler order for each line, 0 for lines that can not be reached
+      from a head line (cycles).
+
+    """
+    # exact endpoint matching, one node per distinct point
+    nodes = dict()
+    node_a = [nodes.setdefault(first_point, len(nodes)) for first_point, _ in lines]
+    node_b = [nodes.setdefault(last_point, len(nodes)) for _, last_point in lines]
+
+    graph = fct.network_graph.NetworkGraph(node_a, node_b, np.zeros(len(lines)))
+
+    return graph.strahler_order().tolist()
+
+@fct.report.instrument
+def CreateSources(hydro_network, output_sources, overwrite=True, method='strahler', batch_size=10000):
     """
     Create stream sources from reference hydrologic network : 
 
@@ -252,6 +622,12 @@ def CreateSources(hydro_network, output_sources, overwrite=True):
         - hydrography_strahler_fieldbuf (str): The filename for hydro network pepared.
         - sources (str) : stream sources filename path output.
     - overwrite (bool): Optional. Specifies whether to overwrite existing tiled buffer files. Default is True.
+    - method (str): Optional. How to select the source reaches. Default is 'strahler'.
+        - 'strahler': reaches with STRAHLER = 1, filtered by OGR with an attribute query.
+        - 'topology': reaches with no upstream reach, i.e. whose first point is
+          not the last point of another reach, found on the compact network graph
+          (see fct.network_graph.NetworkGraph). Used when the STRAHLER field is missing.
+    - batch_size (int): Optional. Number of sources written per transaction. Default is 10000.
 
     Returns:
     - None
@@ -267,8 +643,17 @@ def CreateSources(hydro_network, output_sources, overwrite=True):
         click.secho('Output already exists: %s' % output_sources, fg='yellow')
         return
 
+    if method not in ('strahler', 'topology'):
+        raise ValueError('Unsupported method %s, expected strahler or topology' % method)
+
     with fiona.open(hydro_network, 'r') as hydro:
 
+        fct.report.count(len(hydro), 'features')
+
+        if method == 'strahler' and 'STRAHLER' not in hydro.schema['properties']:
+            click.secho('No STRAHLER field, sources are found from the network topology', fg='yellow')
+            method = 'topology'
+
         # Create output schema
         schema = hydro.schema.copy()
         schema['geometry'] = 'Point'
@@ -277,21 +662,126 @@ def CreateSources(hydro_network, output_sources, overwrite=True):
             driver=hydro.driver,
             schema=schema,
             crs=hydro.crs)
-        
+
+        if method == 'strahler':
+            # extract network line with strahler = 1 in OGR
+            heads = hydro.filter(where='"STRAHLER" = 1')
+        else:
+            # extract network line without upstream line, found on the network graph
+            sources = fct.network_graph.NetworkGraph.from_network(hydro_network).is_source()
+            heads = (feature for feature, source in zip(hydro, sources.tolist()) if source)
+
         with fiona.open(output_sources, 'w', **options) as output:
-            with click.progressbar(hydro) as processing:
-            # extract network line with strahler = 1 and create point with first line point coordinates
-                for feature in processing:
-                    if feature['properties']['STRAHLER'] == 1:
-                        properties = feature['properties']
-                        geom = shape(feature['geometry'])
-                        head_point = Point(geom.coords[0][:2])
+            batch = []
+            # create point with first line point coordinates
+            for feature in heads:
+                batch.append({
+                    'geometry': {'type': 'Point', 'coordinates': tuple(feature['geometry']['coordinates'][0][:2])},
+                    'properties': feature['properties'],
+                })
+
+                if len(batch) == batch_size:
+                    output.writerecords(batch)
+                    batch = []
+
+            if batch:
+                output.writerecords(batch)
+
+def read_line_endpoints(network, batch_size=10000):
+    """
+    Read the endpoints and lengths of the lines of a network, by batches of
+    features whose lengths are computed on the coordinates arrays: only the
+    endpoints and lengths are kept.
+
+    Parameters:
+    - network (str): Path to the lines file.
+    - batch_size (int): Optional. Number of features read at once. Default is 10000.
+
+    Returns:
+    - numpy.ndarray: (x, y) coordinates of the first then the last point of each line.
+    - numpy.ndarray: Length of each line.
+    """
+    endpoints = []
+    lengths = []
 
-                        output.write({
-                            'geometry': mapping(head_point),
-                            'properties': properties,
-                        })
+    def measure(lines):
+        coordinates = np.concatenate([np.asarray(line, dtype=np.float64)[:, :2] for line in lines])
+        counts = np.array([len(line) for line in lines])
+        starts = np.cumsum(counts) - counts
 
+        segments = np.hypot(*np.diff(coordinates, axis=0).T)
+        # segments joining two lines do not count
+        segments = np.append(segments, 0.0)
+        segments[starts[1:] - 1] = 0.0
+        lengths.append(np.add.reduceat(segments, starts))
+
+        endpoints.append(coordinates[starts])
+        endpoints.append(coordinates[starts + counts - 1])
+
+    with fiona.open(network) as fs:
+        batch = []
+        for feature in fs:
+            batch.append(feature['geometry']['coordinates'])
+            if len(batch) == batch_size:
+                measure(batch)
+                batch = []
+        if batch:
+            measure(batch)
+
+    if not lengths:
+        return np.zeros((0, 2)), np.zeros(0)
+
+    # first points then last points of each batch, interleaved back to the feature order
+    first = np.concatenate(endpoints[0::2])
+    last = np.concatenate(endpoints[1::2])
+    coordinates = np.empty((2 * len(first), 2))
+    coordinates[0::2] = first
+    coordinates[1::2] = last
+
+    return coordinates, np.concatenate(lengths)
+
+def index_endpoints(coordinates):
+    """
+    Quantize line endpoints coordinates and give the same node GID to the
+    endpoints with the same quantized coordinates, nodes are numbered by first appearance.
+
+    Parameters:
+    - coordinates (list): Endpoints (x, y) coordinates.
+
+    Returns:
+    - numpy.ndarray: Node GID of each endpoint.
+    - numpy.ndarray: Coordinates of each node, indexed by GID.
+    """
+    coordinates = np.array(coordinates, dtype='float64').reshape(-1, 2)
+
+    if len(coordinates) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2))
+
+    minx = np.min(coordinates[:, 0])
+    miny = np.min(coordinates[:, 1])
+    maxx = np.max(coordinates[:, 0])
+    maxy = np.max(coordinates[:, 1])
+
+    quantization = 1e8
+    kx = (minx == maxx) and 1 or (maxx - minx)
+    ky = (miny == maxy) and 1 or (maxy - miny)
+    sx = kx / quantization
+    sy = ky / quantization
+
+    coordinates = np.int32(np.round((coordinates - (minx, miny)) / (sx, sy)))
+
+    # one node per distinct quantized coordinate, numbered by first appearance
+    keys, first_index, inverse = np.unique(
+        coordinates, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    appearance = np.argsort(first_index, kind='stable')
+    key_gid = np.empty(len(keys), dtype=np.int64)
+    key_gid[appearance] = np.arange(len(keys))
+
+    return key_gid[inverse], keys[appearance] * (sx, sy) + (minx, miny)
+
+@fct.report.instrument
 def IdentifyNetworkNodes(network, network_nodes, network_identified, crs):
     """
     Identifies network nodes by finding the endpoints of lines in a given network dataset and 
@@ -315,44 +805,21 @@ def IdentifyNetworkNodes(network, network_nodes, network_identified, crs):
     """
     # Step 1
     click.secho('Get lines endpoints', fg='yellow')
-    coordinates = list()
-    
-    def extract_coordinates(polyline):
-        """ Extract endpoints coordinates
-        """
-
-        a = polyline['coordinates'][0]
-        b = polyline['coordinates'][-1]
-        coordinates.append(tuple(a))
-        coordinates.append(tuple(b))
-        
+
+    # endpoints read by batches in NumPy arrays, first point then last point of each line
+    coordinates, _ = read_line_endpoints(network)
+
     with fiona.open(network) as fs:
 
-        with click.progressbar(fs) as processing:
-            for feature in processing:
-                
-                extract_coordinates(feature['geometry'])
-                
-        # Step 2
-        click.secho('Quantize coordinates', fg='yellow')
-        
-        coordinates = np.array(coordinates)
-        minx = np.min(coordinates[:, 0])
-        miny = np.min(coordinates[:, 1])
-        maxx = np.max(coordinates[:, 0])
-        maxy = np.max(coordinates[:, 1])
-
-        quantization = 1e8
-        kx = (minx == maxx) and 1 or (maxx - minx)
-        ky = (miny == maxy) and 1 or (maxy - miny)
-        sx = kx / quantization
-        sy = ky / quantization
-
-        coordinates = np.int32(np.round((coordinates - (minx, miny)) / (sx, sy)))    
-        
-        # Step 3
-        click.secho('Build endpoints index', fg='yellow')
-        
+        fct.report.count(len(fs), 'features')
+
+        # Step 2 and 3
+        click.secho('Quantize coordinates and build endpoints index', fg='yellow')
+
+        endpoints_gid, nodes_coordinates = index_endpoints(coordinates)
+
+        del coordinates
+
         driver = 'GPKG'
         schema = {
             'geometry': 'Point',
@@ -362,52 +829,23 @@ def IdentifyNetworkNodes(network, network_nodes, network_identified, crs):
         }
         crs = fiona.crs.CRS.from_epsg(crs)
         options = dict(driver=driver, crs=crs, schema=schema)
-        
+
         with fiona.open(network_nodes, 'w', **options) as dst:
-            
-            coordinates_map = dict()
-            gid = 0
-            
-            point_index = dict()
-            
-            with click.progressbar(enumerate(coordinates), length=len(coordinates)) as processing:
-                for i, coordinate in processing:
-                    
-                    c = tuple(coordinate)
-                    
-                    if c not in coordinates_map:
-                        
-                        coordinates_map[c] = i
-                        node_coords = (c[0]*sx + minx, c[1]*sy + miny)
-                         
-                        point_index[gid] = Point(node_coords[0], node_coords[1])
-                        
-                        dst.write({
-                            'type': 'Feature',
-                            'geometry': {'type': 'Point', 'coordinates': node_coords},
-                            'properties': {'GID': gid}
-                        }) 
-
-                        gid = gid + 1
-
-            del coordinates
-            del coordinates_map
-            
+            dst.writerecords(
+                {
+                    'type': 'Feature',
+                    'geometry': {'type': 'Point', 'coordinates': (float(x), float(y))},
+                    'properties': {'GID': gid}
+                }
+                for gid, (x, y) in enumerate(nodes_coordinates)
+            )
+
         # Step 4
         click.secho('Output lines with nodes attributes', fg='yellow')
-        
-        nodes_list = MultiPoint(list(point_index.values()))
-
-        def nearest(point):
-            """ Return the nearest point in the point index
-            """
-            nearest_node = nearest_points(point, nodes_list)[1]
-            
-            for candidate in point_index:
-                if point_index[candidate].equals(nearest_node):
-                    return candidate
-                
-            return None
+
+        # endpoints were extracted in feature order, first point then last point
+        nodes_a = endpoints_gid[0::2].tolist()
+        nodes_b = endpoints_gid[1::2].tolist()
 
         schema = fs.schema
         schema['properties']['NODEA'] = 'int:10'
@@ -416,20 +854,204 @@ def IdentifyNetworkNodes(network, network_nodes, network_identified, crs):
         options = dict(driver=driver, crs=crs, schema=schema)
 
         with fiona.open(network_identified, 'w', **options) as dst:
-            with click.progressbar(fs) as processing:
-                for feature in processing:
-                    
-                    output_feature = feature
-                    
-                    a = Point(output_feature['geometry']['coordinates'][0])
-                    b = Point(output_feature['geometry']['coordinates'][-1])
-                    
-                    output_feature['properties']['NODEA'] = nearest(a)
-                    output_feature['properties']['NODEB'] = nearest(b)
-                    
-                    dst.write(output_feature)
-
-def prepare_network_attribut(network_file, output_file, crs):
+            with click.progressbar(zip(fs, nodes_a, nodes_b), length=len(nodes_a)) as processing:
+                dst.writerecords(
+                    {
+                        'type': 'Feature',
+                        'properties': {**feature['properties'], 'NODEA': node_a, 'NODEB': node_b},
+                        'geometry': feature['geometry'],
+                    }
+                    for feature, node_a, node_b in processing
+                )
+
+def find_cycle_lines(nodes_a, nodes_b, node_count):
+    """
+    Find the lines on a cycle of the directed network graph (or between two cycles):
+    the lines neither reached from the sources following the flow, nor from the outlets going upstream.
+
+    Parameters:
+    - nodes_a (numpy.ndarray): Upstream node GID of each line.
+    - nodes_b (numpy.ndarray): Downstream node GID of each line.
+    - node_count (int): Number of nodes.
+
+    Returns:
+    - numpy.ndarray: Boolean array, True for the lines on a cycle.
+    """
+    def traverse(start_nodes, end_nodes):
+        # Kahn traversal, a line is visited when all the lines flowing to its start node are visited
+        pending = np.bincount(end_nodes, minlength=node_count)
+        order = np.argsort(start_nodes, kind='stable')
+        offsets = np.zeros(node_count + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(start_nodes, minlength=node_count))
+
+        visited = np.zeros(len(start_nodes), dtype=bool)
+        pending_list = pending.tolist()
+        queue = np.flatnonzero(pending == 0).tolist()
+
+        while queue:
+            node = queue.pop()
+            for line in order[offsets[node]:offsets[node + 1]].tolist():
+                visited[line] = True
+                next_node = end_nodes[line]
+                pending_list[next_node] -= 1
+                if pending_list[next_node] == 0:
+                    queue.append(next_node)
+
+        return visited
+
+    downstream = traverse(nodes_a, nodes_b)
+    upstream = traverse(nodes_b, nodes_a)
+
+    return ~downstream & ~upstream
+
+@fct.report.instrument
+def ValidateNetworkTopology(network, output_errors, snap_distance=1.0):
+    """
+    Check the topology of a hydrologic network, with lines digitized from
+    upstream to downstream, and write the errors found to a GPKG layer.
+
+    The lines endpoints are indexed on quantized coordinates, like in
+    IdentifyNetworkNodes, and the errors are found on the endpoints graph:
+    - unsnapped: line end not connected to another line, but closer than `snap_distance` to one (point).
+    - divergence: node with more than one outflowing line, a diffluence or a multichannel (point).
+    - sink: node with several inflowing lines and no outflowing line (point).
+    - multichannel: lines joining the same two nodes (line).
+    - cycle: line on a cycle of the flow graph (line).
+    - reversed: line flowing from a divergence to a sink, probably digitized from downstream to upstream (line).
+
+    Parameters:
+    - network (str): The file path of the hydrologic network.
+    - output_errors (str): The file path of the errors GPKG.
+    - snap_distance (float): Optional. Distance under which a line end should be connected to a nearby line,
+      0 to skip the unsnapped ends check. Default is 1.0.
+
+    Returns:
+    - dict: Number of errors by type.
+    """
+    click.secho('Get lines endpoints', fg='yellow')
+
+    with fiona.open(network) as fs:
+        fids = list()
+        geometries = list()
+        coordinates = list()
+
+        for feature in fs:
+            line = feature['geometry']['coordinates']
+            fids.append(int(feature.id))
+            geometries.append(shapely.linestrings([point[:2] for point in line]))
+            coordinates.append(tuple(line[0][:2]))
+            coordinates.append(tuple(line[-1][:2]))
+
+        fct.report.count(len(fs), 'features')
+        crs = fs.crs
+
+    click.secho('Build endpoints graph', fg='yellow')
+
+    endpoints_gid, nodes_coordinates = index_endpoints(coordinates)
+    del coordinates
+
+    nodes_a = endpoints_gid[0::2]
+    nodes_b = endpoints_gid[1::2]
+    node_count = len(nodes_coordinates)
+    inflow = np.bincount(nodes_b, minlength=node_count)
+    outflow = np.bincount(nodes_a, minlength=node_count)
+
+    node_errors = list()
+    line_errors = list()
+
+    click.secho('Check nodes', fg='yellow')
+
+    # line ends connected to nothing else, unsnapped if near a line
+    # other than their own line and the lines connected to it
+    dangling = np.flatnonzero(inflow + outflow == 1)
+    line_of_node = np.full(node_count, -1, dtype=np.int64)
+    line_of_node[nodes_a] = np.arange(len(nodes_a))
+    line_of_node[nodes_b] = np.arange(len(nodes_b))
+
+    if len(dangling) and snap_distance:
+        lines_index = shapely.STRtree(geometries)
+        points = shapely.points(nodes_coordinates[dangling])
+        point_index, line_index = lines_index.query(points, predicate='dwithin', distance=snap_distance)
+        own_line = line_of_node[dangling[point_index]]
+        connected = (
+            (nodes_a[line_index] == nodes_a[own_line]) | (nodes_a[line_index] == nodes_b[own_line])
+            | (nodes_b[line_index] == nodes_a[own_line]) | (nodes_b[line_index] == nodes_b[own_line]))
+        unsnapped = point_index[~connected]
+        node_errors.extend(('unsnapped', node) for node in np.unique(dangling[unsnapped]).tolist())
+
+    node_errors.extend(('divergence', node) for node in np.flatnonzero(outflow > 1).tolist())
+    node_errors.extend(('sink', node) for node in np.flatnonzero((inflow > 1) & (outflow == 0)).tolist())
+
+    click.secho('Check lines', fg='yellow')
+
+    # lines joining the same two nodes, whatever their direction
+    pairs = np.sort(np.column_stack([nodes_a, nodes_b]), axis=1)
+    _, pair_index, pair_count = np.unique(pairs, axis=0, return_inverse=True, return_counts=True)
+    pair_index = pair_index.reshape(-1)
+    line_errors.extend(('multichannel', line) for line in np.flatnonzero(pair_count[pair_index] > 1).tolist())
+
+    line_errors.extend(('cycle', line) for line in np.flatnonzero(find_cycle_lines(nodes_a, nodes_b, node_count)).tolist())
+
+    reversed_lines = (outflow[nodes_a] > 1) & (inflow[nodes_b] > 1) & (outflow[nodes_b] == 0)
+    line_errors.extend(('reversed', line) for line in np.flatnonzero(reversed_lines).tolist())
+
+    click.secho('Write errors', fg='yellow')
+
+    schema = {
+        'geometry': 'Unknown',
+        'properties': [
+            ('ERROR', 'str:16'),
+            ('FEATURE', 'int'),
+            ('NODE', 'int')
+        ]
+    }
+    options = dict(driver='GPKG', crs=crs, schema=schema)
+
+    with fiona.open(output_errors, 'w', **options) as dst:
+        dst.writerecords(
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': tuple(nodes_coordinates[node].tolist())},
+                'properties': {'ERROR': error, 'FEATURE': None, 'NODE': node}
+            }
+            for error, node in node_errors
+        )
+        dst.writerecords(
+            {
+                'type': 'Feature',
+                'geometry': mapping(geometries[line]),
+                'properties': {'ERROR': error, 'FEATURE': fids[line], 'NODE': None}
+            }
+            for error, line in line_errors
+        )
+
+    errors = dict()
+    for error, _ in node_errors + line_errors:
+        errors[error] = errors.get(error, 0) + 1
+
+    for error, count in errors.items():
+        click.secho('%d %s errors' % (count, error), fg='red')
+
+    if not errors:
+        click.secho('No topology error', fg='green')
+
+    return errors
+
+def parse_axis(liens_vers_cours_d_eau):
+    """
+    Return the AXIS number of a BD TOPO river link (COURDEAU0000002000794211 -> 2000794211),
+    None if the link is missing or malformed.
+    """
+    if liens_vers_cours_d_eau is None:
+        return None
+
+    axis = liens_vers_cours_d_eau[8:]
+
+    # ASCII digits only, like the columnar path: isdigit accepts superscripts int does not parse
+    return int(axis) if axis.isascii() and axis.isdecimal() else None
+
+@fct.report.instrument
+def prepare_network_attribut(network_file, output_file, crs, columnar=False, batch_size=65536):
     """
     Prepare network attributes and create a new output file with additional fields.
 
@@ -437,6 +1059,9 @@ def prepare_network_attribut(network_file, output_file, crs):
     - network_file (str): Path to the input network file.
     - output_file (str): Path to the output file where the modified network will be saved.
     - crs (dict): Coordinate Reference System information to be used for the output file.
+    - columnar (bool): Optional. Read, derive the fields and write by Arrow record batches
+      of batch_size features, with vectorized operations (requires pyogrio and pyarrow). Default is False.
+    - batch_size (int): Optional. Number of features of the record batches in columnar mode. Default is 65536.
 
     Returns:
     None
@@ -445,6 +1070,7 @@ def prepare_network_attribut(network_file, output_file, crs):
     and creates a new output file with the modified schema and additional fields.
 
     The new fields are populated based on existing properties in the input network file.
+    AXIS is null when liens_vers_cours_d_eau is missing or malformed.
 
     Raises:
     IOError: If there is an issue opening or processing the network file.
@@ -453,6 +1079,10 @@ def prepare_network_attribut(network_file, output_file, crs):
 
     fields_to_remove = ['date_creation', 'date_modification', 'date_d_apparition', 'date_de_confirmation']
 
+    if columnar:
+        prepare_network_attribut_columnar(network_file, output_file, fields_to_remove, batch_size)
+        return
+
     # open network file
     with fiona.open(network_file) as source:
         schema = {
@@ -462,6 +1092,8 @@ def prepare_network_attribut(network_file, output_file, crs):
         driver=source.driver
         crs=source.crs
 
+        fct.report.count(len(source), 'features')
+
         # define the new fields
         cdentitehy_field_name = "CDENTITEHY"
         cdentitehy_field_type = 'str'
@@ -486,8 +1118,7 @@ def prepare_network_attribut(network_file, output_file, crs):
 
                     # update features new fields
                     properties[cdentitehy_field_name] = properties['code_du_cours_d_eau_bdcarthage']
-                    liens_vers_cours_d_eau = properties['liens_vers_cours_d_eau']
-                    properties[axis_field_name] = int(liens_vers_cours_d_eau[8:])
+                    properties[axis_field_name] = parse_axis(properties['liens_vers_cours_d_eau'])
                     properties[toponyme_field_name] = properties['cpx_toponyme_de_cours_d_eau']
 
                     # create the feature to copy in output file
@@ -502,3 +1133,60 @@ def prepare_network_attribut(network_file, output_file, crs):
 
     print(cdentitehy_field_name + ', ' + axis_field_name + ' and ' + toponyme_field_name + ' fields adds and populate to ' + output_file)
 
+def prepare_network_attribut_columnar(network_file, output_file, fields_to_remove, batch_size=65536):
+    """
+    Columnar version of prepare_network_attribut.
+
+    The network is streamed as Arrow record batches from OGR to OGR: the date
+    fields are dropped and CDENTITEHY, AXIS and TOPONYME are derived with
+    vectorized string and integer operations, without any per feature Python
+    object.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyogrio
+    import pyogrio.raw
+
+    driver = pyogrio.read_info(network_file)['driver']
+
+    with pyogrio.raw.open_arrow(network_file, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        input_schema = reader.schema
+
+        # output schema, fields kept in order then the new fields, geometry last
+        fields = [field for field in input_schema if field.name not in fields_to_remove and field.name != geometry_name]
+        schema = pa.schema(
+            fields + [
+                pa.field('CDENTITEHY', pa.string()),
+                pa.field('AXIS', pa.int64()),
+                pa.field('TOPONYME', pa.string()),
+                input_schema.field(geometry_name)
+            ],
+            metadata=input_schema.metadata)
+
+        def batches():
+            for batch in reader:
+                fct.report.count(batch.num_rows, 'features')
+
+                # AXIS from liens_vers_cours_d_eau[8:], null when not a number
+                axis = pc.utf8_slice_codeunits(batch.column('liens_vers_cours_d_eau'), 8)
+                axis = pc.if_else(pc.match_substring_regex(axis, '^[0-9]+$'), axis, pa.scalar(None, pa.string()))
+
+                yield pa.RecordBatch.from_arrays(
+                    [batch.column(field.name) for field in fields] + [
+                        pc.cast(batch.column('code_du_cours_d_eau_bdcarthage'), pa.string()),
+                        pc.cast(axis, pa.int64()),
+                        pc.cast(batch.column('cpx_toponyme_de_cours_d_eau'), pa.string()),
+                        batch.column(geometry_name)
+                    ],
+                    schema=schema)
+
+        pyogrio.raw.write_arrow(
+            pa.RecordBatchReader.from_batches(schema, batches()),
+            output_file,
+            driver=driver,
+            geometry_name=geometry_name,
+            geometry_type=meta['geometry_type'],
+            crs=meta['crs'])
+
+    print('CDENTITEHY, AXIS and TOPONYME fields adds and populate to ' + output_file)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+-------------------------------------------------------------------------------
+"This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import hashlib
+import click
+import fct.utils
+import fct.report
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage:
+    """
+    A workflow stage: a function called with keyword arguments, which reads
+    some input files or folders and writes some output files or folders.
+    """
+
+    def __init__(self, name, func, kwargs=None, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or dict()
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def run(self):
+        return self.func(**self.kwargs)
+
+
+def fingerprint_path(path):
+    """
+    Fingerprint of a file (size and mtime) or of a folder (size and mtime of
+    every file inside), None if the path does not exist.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    digest.update('{}:{}:{}\n'.format(entry.name, stat.st_size, stat.st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    return None
+
+
+def fingerprint_stage(stage):
+    """
+    Fingerprint of a stage inputs and parameters.
+    """
+    content = {
+        'func': '{}.{}'.format(stage.func.__module__, stage.func.__qualname__),
+        'kwargs': stage.kwargs,
+        'inputs': {path: fingerprint_path(path) for path in stage.inputs},
+        'outputs': stage.outputs
+    }
+
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Runner:
+    """
+    Run workflow stages in dependency order, like make.
+
+    A stage depends on the stages writing its inputs. Stages are skipped when
+    their outputs exist and the fingerprint of their inputs and parameters
+    matches the last successful run, recorded in the `state_path` JSON file.
+    Each stage run is measured in the fct.report records, and the stages
+    named in `profile` are profiled with cProfile to `profile_dir`/<stage>.prof.
+    Independent stages run concurrently on `jobs` threads. When a stage fails
+    or the run is interrupted, no new stage is started and the commands of the
+    running ones are terminated.
+    """
+
+    def __init__(self, stages, state_path, jobs=2, profile=(), profile_dir='.'):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.jobs = jobs
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+
+        # stage producing each output
+        producers = dict()
+        for stage in stages:
+            for output in stage.outputs:
+                producers[output] = stage.name
+
+        self.dependencies = {
+            stage.name: set(producers[path] for path in stage.inputs if path in producers) - {stage.name}
+            for stage in stages
+        }
+
+    def downstream(self, name):
+        """
+        Return the stage and all the stages depending on it, directly or not.
+        """
+        if name not in self.stages:
+            raise ValueError('Unknown stage %s, expected one of %s' % (name, ', '.join(self.stages)))
+
+        selected = {name}
+        changed = True
+        while changed:
+            changed = False
+            for stage, dependencies in self.dependencies.items():
+                if stage not in selected and dependencies & selected:
+                    selected.add(stage)
+                    changed = True
+
+        return selected
+
+    def read_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return dict()
+
+    def write_state(self, state):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def run_stage(self, stage):
+        profile_path = None
+        if stage.name in self.profile:
+            profile_path = os.path.join(self.profile_dir, stage.name + '.prof')
+
+        with fct.report.Measure(stage.name, profile_path):
+            return stage.run()
+
+    def run(self, only=None, start=None, force=False):
+        """
+        Run the stages.
+
+        Parameters:
+        - only (list): Optional. Run only these stages.
+        - start (str): Optional. Run this stage and all the stages downstream, whatever their fingerprint.
+        - force (bool): Optional. Run the selected stages whatever their fingerprint. Default is False.
+
+        Returns:
+        - list: Names of the stages run, skipped stages excluded.
+        """
+        for name in only or ():
+            if name not in self.stages:
+                raise ValueError('Unknown stage %s, expected one of %s' % (name, ', '.join(self.stages)))
+
+        selected = set(only) if only else set(self.stages)
+        forced = set(self.stages) if force else set()
+
+        if start is not None:
+            from_stages = self.downstream(start)
+            selected &= from_stages
+            forced |= from_stages
+
+        state = self.read_state()
+        pending = [name for name in self.stages if name in selected]
+        done = set(self.stages) - selected
+        running = dict()
+        executed = []
+
+        def submit(executor, name):
+            stage = self.stages[name]
+            fingerprint = fingerprint_stage(stage)
+
+            if (name not in forced and state.get(name) == fingerprint
+                    and all(os.path.exists(output) for output in stage.outputs)):
+                click.secho('Skip stage %s, up to date' % name, fg='green')
+                return False
+
+            click.secho('Run stage %s' % name, fg='yellow')
+            running[executor.submit(self.run_stage, stage)] = (name, fingerprint)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            try:
+                while pending or running:
+                    # submit every stage whose dependencies are done, skipped stages are done at once
+                    submitted = True
+                    while submitted:
+                        submitted = False
+                        for name in list(pending):
+                            if self.dependencies[name] <= done:
+                                pending.remove(name)
+                                if not submit(executor, name):
+                                    done.add(name)
+                                submitted = True
+
+                    if not running:
+                        break
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                    failed = []
+
+                    for future in finished:
+                        name, fingerprint = running.pop(future)
+
+                        if future.exception() is not None:
+                            click.secho('Stage %s failed' % name, fg='red')
+                            failed.append(future)
+                            continue
+
+                        state[name] = fingerprint
+                        self.write_state(state)
+                        done.add(name)
+                        executed.append(name)
+                        click.secho('Stage %s done' % name, fg='green')
+
+                    # fail fast once the stages finished at the same time are recorded
+                    if failed:
+                        failed[0].result()
+            except BaseException:
+                # on a stage error or a Ctrl-C, stop the commands of the running stages
+                # (they run in their own session, out of reach of the terminal signals)
+                # and cancel the stages not started yet, before the executor awaits
+                # the running stages on exit
+                fct.utils.terminate_running_processes()
+                for future in running:
+                    future.cancel()
+                raise
+
+        return executed
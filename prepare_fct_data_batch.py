@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+-------------------------------------------------------------------------------
+"This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+
+Prepare the Fluvial Corridor Toolbox datasets of several watersheds from the
+same landuse and DEM tiles and hydrological network. The tilesets are built
+once for the batch, then the stages of each watershed (tiles extraction,
+virtual rasters, network clip and preparation ...) run in parallel processes.
+"""
+
+import os
+import argparse
+import traceback
+import click
+import config.config
+import fct.utils
+import fct.workflow
+import fct.vector_tools
+import fct.report
+from prepare_fct_data_workflow import build_stages
+
+# stages and paths shared by all the watersheds
+SHARED_STAGES = ['tileset_landuse', 'tileset_dem']
+SHARED_PATHS = [
+    'inputs_dir_landuse_tiles', 'tileset_landuse', 'landuse_cache_dir',
+    'inputs_dir_dem_tiles', 'tileset_dem', 'dem_cache_dir',
+    'hydro_network'
+]
+
+def watershed_config(batch_config, mask, output_dir):
+    """
+    Configuration of a watershed: the batch configuration with the watershed
+    mask, and the other watershed outputs in `output_dir`/<mask name>/. The
+    hydrological network is always clipped to the mask.
+
+    Parameters:
+    - batch_config (config.config.Config): The batch configuration.
+    - mask (str): The watershed mask GPKG.
+    - output_dir (str): The batch outputs folder.
+
+    Returns:
+    - config.config.Config: The watershed configuration.
+    """
+    name = os.path.splitext(os.path.basename(mask))[0]
+    watershed_dir = os.path.join(output_dir, name)
+    paths = dict()
+
+    for key, path in batch_config.paths.items():
+        if key in SHARED_PATHS or not path:
+            paths[key] = path
+        elif path.endswith(('/', os.sep)):
+            # folder paths keep their trailing separator
+            paths[key] = os.path.join(watershed_dir, os.path.basename(path.rstrip('/' + os.sep)), '')
+        else:
+            paths[key] = os.path.join(watershed_dir, os.path.basename(path))
+
+    paths['mask'] = mask
+    paths['hydro_network_clip'] = paths.get('hydro_network_clip') or os.path.join(watershed_dir, 'hydro_network_clip.gpkg')
+    paths['workflow_state'] = os.path.join(watershed_dir, 'workflow_state.json')
+    paths['workflow_report'] = os.path.join(watershed_dir, 'workflow_report.json')
+
+    return config.config.Config(paths, dict(batch_config.params), batch_config.filename)
+
+def run_watershed(watershed, force=False):
+    """
+    Run the stages of a watershed, except the shared ones, in a worker process.
+
+    Returns:
+    - list: Names of the stages run.
+    """
+    # the pool processes are reused, keep only the records of this watershed in its report
+    fct.report.reset()
+    os.makedirs(os.path.dirname(watershed.paths['workflow_state']), exist_ok=True)
+    stages = [stage for stage in build_stages(watershed) if stage.name not in SHARED_STAGES]
+    runner = fct.workflow.Runner(
+        stages,
+        state_path = watershed.paths['workflow_state'],
+        jobs = watershed.params['jobs'])
+
+    try:
+        return runner.run(force=force)
+    finally:
+        fct.report.write_report(watershed.paths['workflow_report'])
+
+def run_batch(batch_config, masks, output_dir, watershed_jobs=2, force=False):
+    """
+    Build the shared tilesets once, then run the watersheds in `watershed_jobs` processes.
+
+    Parameters:
+    - batch_config (config.config.Config): The batch configuration.
+    - masks (list): The watersheds mask GPKG.
+    - output_dir (str): The batch outputs folder, with a folder per watershed.
+    - watershed_jobs (int): Optional. Number of watersheds prepared at the same time. Default is 2.
+    - force (bool): Optional. Run the stages even if they are up to date. Default is False.
+
+    Returns:
+    - dict: Error message of the failed watersheds, by watershed name.
+    """
+    names = [os.path.splitext(os.path.basename(mask))[0] for mask in masks]
+    if len(set(names)) != len(names):
+        raise ValueError('The masks file names must be distinct, they name the watersheds outputs folders')
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # the tilesets of all the tiles, indexed once for the batch
+    click.secho('Build the shared tilesets', fg='yellow')
+    shared = [stage for stage in build_stages(batch_config) if stage.name in SHARED_STAGES]
+    fct.workflow.Runner(shared, state_path=os.path.join(output_dir, 'batch_state.json'), jobs=len(shared)).run(force=force)
+
+    # and the tilesets and network spatial indexes, if they have no GeoPackage R*Tree
+    for path in (batch_config.paths['tileset_landuse'], batch_config.paths['tileset_dem'], batch_config.paths['hydro_network']):
+        fct.vector_tools.ensure_spatial_index(path)
+
+    watersheds = {name: watershed_config(batch_config, mask, output_dir) for name, mask in zip(names, masks)}
+    failed = dict()
+
+    with fct.utils.process_pool(watershed_jobs) as executor:
+        futures = {name: executor.submit(run_watershed, watershed, force) for name, watershed in watersheds.items()}
+
+        for name, future in futures.items():
+            # a failed watershed does not stop the others
+            try:
+                future.result()
+                click.secho('Watershed %s done' % name, fg='green')
+            except Exception:
+                failed[name] = traceback.format_exc()
+                click.secho('Watershed %s failed' % name, fg='red')
+
+    return failed
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Prepare the Fluvial Corridor Toolbox datasets of several watersheds.')
+    parser.add_argument('masks', nargs='+', help='watersheds mask GPKG, one per watershed')
+    parser.add_argument('--config', default='config/config.ini', help='config file, config/config.ini by default')
+    parser.add_argument('--output-dir', required=True, help='batch outputs folder, with a folder per watershed named after its mask')
+    parser.add_argument('--watershed-jobs', type=int, default=2, help='number of watersheds prepared at the same time')
+    parser.add_argument('--force', action='store_true', help='run the stages even if they are up to date')
+    args = parser.parse_args()
+
+    batch_config = config.config.load_config(args.config)
+
+    for mask in args.masks:
+        if not os.path.exists(mask):
+            raise ValueError('Mask %s does not exist' % mask)
+
+    failed = run_batch(batch_config, args.masks, args.output_dir, args.watershed_jobs, args.force)
+
+    for name, error in failed.items():
+        click.secho('Watershed %s failed:\n%s' % (name, error), fg='red')
+
+    if failed:
+        raise SystemExit(1)
@@ -18,80 +18,304 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 -------------------------------------------------------------------------------
 """
 
+import os
+import argparse
 import config.config
 import fct.raster_tools
 import fct.vector_tools
+import fct.network_graph
 import fct.utils
+import fct.workflow
+import fct.report
+from fct.workflow import Stage
 
-# parameters
-paths = config.config.paths_config()
-params = config.config.parameters_config()
-
-# create dem and landuse tileset
-fct.raster_tools.CreateTilesetFromRasters(
-    input_dir_path = paths['inputs_dir_landuse_tiles'],
-    extension = params['landuse_extension'],
-    tileset_path = paths['tileset_landuse'],
-    crs = params['crs']
-)
-
-fct.raster_tools.CreateTilesetFromRasters(
-    input_dir_path = paths['inputs_dir_dem_tiles'],
-    extension = params['dem_extension'],
-    tileset_path = paths['tileset_dem'],
-    crs = params['crs']
-)
-
-# get intersection between mask and tileset
-fct.vector_tools.ExtractBylocation(paths['tileset_landuse'], paths['mask'], paths['tileset_mask_landuse'], method = 'intersects')
-fct.vector_tools.ExtractBylocation(paths['tileset_dem'], paths['mask'], paths['tileset_mask_dem'], method = 'intersects')
-# RGEALTI_FXX_0948_6457_MNT_LAMB93_IGN69.asc manquant lorsque lancement de l'Isère seule, pas de problème visible pour RMC.
-
-# copy raster tiles
-fct.raster_tools.ExtractRasterTilesFromTileset(
-    tileset_path = paths['tileset_mask_landuse'],
-    raster_dir = paths['inputs_dir_landuse_tiles'],
-    dest_dir = paths['outputs_dir_landuse_tiles']
-)
-
-fct.raster_tools.ExtractRasterTilesFromTileset(
-    tileset_path = paths['tileset_mask_dem'],
-    raster_dir = paths['inputs_dir_dem_tiles'],
-    dest_dir = paths['outputs_dir_dem_tiles']
-)
-
-# create virtual raster
-bash_landuse = 'gdalbuildvrt -a_srs "EPSG:{}" "{}" "{}"*"{}"'.format(params['crs'], 
-                                                                      paths['landuse_vrt'], 
-                                                                      paths['outputs_dir_landuse_tiles'], 
-                                                                      params['landuse_extension'])
-fct.utils.process_with_stdout(bash_landuse)
-
-# create a text file with the list of the dem file for long list to avoid error argument list too long
-dem_masked_files = 'find {} -name "*{}" > {}'.format(paths['outputs_dir_dem_tiles'],
-                                                               params['dem_extension'],
-                                                               paths['dem_masked_files'])
-
-fct.utils.process_with_stdout(dem_masked_files)
-
-bash_dem = 'gdalbuildvrt -a_srs EPSG:{} -input_file_list {} {}'.format(
-                                                                  params['crs'],
-                                                                  paths['dem_masked_files'],
-                                                                  paths['dem_vrt'])
-
-fct.utils.process_with_stdout(bash_dem)
-
-# fit landuse pixels on dem
-fct.raster_tools.fit_raster_pixel(raster_to_fit = paths['landuse_vrt'], 
-                 reference_raster = paths['dem_vrt'],
-                 output_raster = paths['landuse_fit'])
-
-# Prepare the attibut table to the Fluvial Corridor Toolbox needs
-fct.vector_tools.prepare_network_attribut(network_file = paths['hydro_network'], 
-                                          output_file = paths['hydro_network_output'],
-                                          crs = params['crs'])
-
-# Create networks sources
-fct.vector_tools.CreateSources(hydro_network = paths['hydro_network_output'], 
-                               output_sources = paths['sources'], 
-                               overwrite=True)
+def build_stages(config):
+    """
+    Build the workflow stages from the configuration paths and parameters.
+
+    Parameters:
+    - config (config.config.Config): The workflow configuration.
+
+    Returns:
+    - list: The stages, in run order.
+    """
+    paths = config.paths
+    params = config.params
+    workers = params['workers']
+    staging_mode = params['staging_mode']
+
+    stages = []
+
+    # create dem and landuse tileset
+    stages.append(Stage(
+        'tileset_landuse',
+        fct.raster_tools.CreateTilesetFromRasters,
+        dict(
+            input_dir_path = paths['inputs_dir_landuse_tiles'],
+            extension = params['landuse_extension'],
+            tileset_path = paths['tileset_landuse'],
+            crs = params['crs'],
+            workers = workers
+        ),
+        inputs = [paths['inputs_dir_landuse_tiles']],
+        outputs = [paths['tileset_landuse']]
+    ))
+
+    stages.append(Stage(
+        'tileset_dem',
+        fct.raster_tools.CreateTilesetFromRasters,
+        dict(
+            input_dir_path = paths['inputs_dir_dem_tiles'],
+            extension = params['dem_extension'],
+            tileset_path = paths['tileset_dem'],
+            crs = params['crs'],
+            workers = workers,
+            name_pattern = params['dem_name_pattern'] or None,
+            tile_size = params['dem_tile_size'] or None,
+            name_unit = params['dem_name_unit'],
+            name_origin = params['dem_name_origin'],
+            name_offset = params['dem_name_offset'],
+            name_sample = params['dem_name_sample']
+        ),
+        inputs = [paths['inputs_dir_dem_tiles']],
+        outputs = [paths['tileset_dem']]
+    ))
+
+    # get intersection between mask and tileset
+    # RGEALTI_FXX_0948_6457_MNT_LAMB93_IGN69.asc manquant lorsque lancement de l'Isère seule, pas de problème visible pour RMC.
+    for dataset in ('landuse', 'dem'):
+        stages.append(Stage(
+            'extract_' + dataset,
+            fct.vector_tools.ExtractBylocation,
+            dict(
+                input_file = paths['tileset_' + dataset],
+                mask_file = paths['mask'],
+                output_file = paths['tileset_mask_' + dataset],
+                method = 'intersects'
+            ),
+            inputs = [paths['tileset_' + dataset], paths['mask']],
+            outputs = [paths['tileset_mask_' + dataset]]
+        ))
+
+    for dataset in ('landuse', 'dem'):
+        # copy raster tiles if staging is enabled, the virtual rasters read the source tiles otherwise
+        if staging_mode != 'none':
+            stages.append(Stage(
+                'stage_' + dataset,
+                fct.raster_tools.ExtractRasterTilesFromTileset,
+                dict(
+                    tileset_path = paths['tileset_mask_' + dataset],
+                    raster_dir = paths['inputs_dir_%s_tiles' % dataset],
+                    dest_dir = paths['outputs_dir_%s_tiles' % dataset],
+                    mode = staging_mode,
+                    workers = workers
+                ),
+                inputs = [paths['tileset_mask_' + dataset]],
+                outputs = [paths['outputs_dir_%s_tiles' % dataset]]
+            ))
+
+            tiles_dir = paths['outputs_dir_%s_tiles' % dataset]
+            vrt_inputs = [paths['tileset_mask_' + dataset], tiles_dir]
+        else:
+            tiles_dir = paths['inputs_dir_%s_tiles' % dataset]
+            vrt_inputs = [paths['tileset_mask_' + dataset]]
+
+        vrt_tileset = paths['tileset_mask_' + dataset]
+
+        # convert the tiles to tiled GeoTIFF in a cache if the cache is set, the virtual raster reads the cache
+        if paths.get(dataset + '_cache_dir'):
+            stages.append(Stage(
+                'convert_' + dataset,
+                fct.raster_tools.ConvertTilesetToGeoTiff,
+                dict(
+                    tileset_path = paths['tileset_mask_' + dataset],
+                    raster_dir = tiles_dir,
+                    cache_dir = paths[dataset + '_cache_dir'],
+                    output_tileset_path = paths['tileset_mask_%s_cache' % dataset],
+                    workers = workers
+                ),
+                inputs = vrt_inputs,
+                outputs = [paths['tileset_mask_%s_cache' % dataset]]
+            ))
+
+            tiles_dir = paths[dataset + '_cache_dir']
+            vrt_tileset = paths['tileset_mask_%s_cache' % dataset]
+            vrt_inputs = [vrt_tileset]
+
+        # create virtual raster
+        stages.append(Stage(
+            'vrt_' + dataset,
+            fct.raster_tools.CreateVrtFromTileset,
+            dict(
+                tileset_path = vrt_tileset,
+                raster_dir = tiles_dir,
+                vrt_path = paths[dataset + '_vrt'],
+                crs = params['crs'],
+                workers = workers
+            ),
+            inputs = vrt_inputs,
+            outputs = [paths[dataset + '_vrt']]
+        ))
+
+    # fit landuse pixels on dem
+    stages.append(Stage(
+        'fit_landuse',
+        fct.raster_tools.fit_raster_pixel,
+        dict(
+            raster_to_fit = paths['landuse_vrt'],
+            reference_raster = paths['dem_vrt'],
+            output_raster = paths['landuse_fit'],
+            cache_max = params['gdal_cachemax'],
+            warp_memory = params['warp_memory']
+        ),
+        inputs = [paths['landuse_vrt'], paths['dem_vrt']],
+        outputs = [paths['landuse_fit']]
+    ))
+
+    # clip the fitted landuse and the dem mosaic to the mask, if the output paths are set
+    for dataset, raster in (('landuse', paths['landuse_fit']), ('dem', paths['dem_vrt'])):
+        if paths.get(dataset + '_clip'):
+            stages.append(Stage(
+                'clip_' + dataset,
+                fct.raster_tools.ClipRasterByPolygon,
+                dict(
+                    raster_path = raster,
+                    polygon_path = paths['mask'],
+                    output_raster_path = paths[dataset + '_clip'],
+                    workers = workers
+                ),
+                inputs = [raster, paths['mask']],
+                outputs = [paths[dataset + '_clip']]
+            ))
+
+    # write the fitted landuse and the dem as cloud optimized GeoTIFF with overviews, if the output paths are set
+    for dataset, raster, resampling in (('landuse', paths['landuse_fit'], 'mode'), ('dem', paths['dem_vrt'], 'average')):
+        if paths.get(dataset + '_cog'):
+            stages.append(Stage(
+                'cog_' + dataset,
+                fct.raster_tools.CreateCloudOptimizedGeoTiff,
+                dict(
+                    input_raster = raster,
+                    output_raster = paths[dataset + '_cog'],
+                    resampling = resampling,
+                    compress = params['cog_compress'],
+                    predictor = params['cog_predictor'],
+                    cache_max = params['gdal_cachemax']
+                ),
+                inputs = [raster],
+                outputs = [paths[dataset + '_cog']]
+            ))
+
+    # clip the hydrological network to the mask, if the output path is set, the next network stages read the clipped network
+    hydro_network = paths['hydro_network']
+
+    if paths.get('hydro_network_clip'):
+        stages.append(Stage(
+            'clip_network',
+            fct.vector_tools.ClipNetworkByMask,
+            dict(
+                network = paths['hydro_network'],
+                mask_file = paths['mask'],
+                output_network = paths['hydro_network_clip'],
+                mode = params['network_clip_mode'],
+                workers = workers
+            ),
+            inputs = [paths['hydro_network'], paths['mask']],
+            outputs = [paths['hydro_network_clip']]
+        ))
+
+        hydro_network = paths['hydro_network_clip']
+
+    # check the hydrological network topology, if the errors output path is set
+    if paths.get('network_errors'):
+        stages.append(Stage(
+            'validate_network',
+            fct.vector_tools.ValidateNetworkTopology,
+            dict(
+                network = hydro_network,
+                output_errors = paths['network_errors'],
+                snap_distance = params['network_snap_distance']
+            ),
+            inputs = [hydro_network],
+            outputs = [paths['network_errors']]
+        ))
+
+    # Prepare the attibut table to the Fluvial Corridor Toolbox needs
+    stages.append(Stage(
+        'network',
+        fct.vector_tools.prepare_network_attribut,
+        dict(
+            network_file = hydro_network,
+            output_file = paths['hydro_network_output'],
+            crs = params['crs'],
+            columnar = params['network_columnar']
+        ),
+        inputs = [hydro_network],
+        outputs = [paths['hydro_network_output']]
+    ))
+
+    # add the Shreve order, upstream length and distance to outlet to the network, if the output path is set
+    if paths.get('hydro_network_metrics'):
+        stages.append(Stage(
+            'network_metrics',
+            fct.network_graph.NetworkMetrics,
+            dict(
+                network = paths['hydro_network_output'],
+                output_network = paths['hydro_network_metrics'],
+                cache_path = paths.get('network_graph') or None
+            ),
+            inputs = [paths['hydro_network_output']],
+            outputs = [paths['hydro_network_metrics']]
+        ))
+
+    # Create networks sources
+    stages.append(Stage(
+        'sources',
+        fct.vector_tools.CreateSources,
+        dict(
+            hydro_network = paths['hydro_network_output'],
+            output_sources = paths['sources'],
+            overwrite = True
+        ),
+        inputs = [paths['hydro_network_output']],
+        outputs = [paths['sources']]
+    ))
+
+    return stages
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Prepare the Fluvial Corridor Toolbox datasets.')
+    parser.add_argument('--config', default='config/config.ini', help='config file, config/config.ini by default')
+    parser.add_argument('--only', nargs='+', metavar='STAGE', help='run only these stages')
+    parser.add_argument('--from', dest='start', metavar='STAGE', help='run this stage and all the stages downstream')
+    parser.add_argument('--force', action='store_true', help='run the stages even if they are up to date')
+    parser.add_argument('--list', action='store_true', help='list the stages and exit')
+    parser.add_argument('--report', help='write a JSON (or .csv) performance report of the run, workflow_report path by default')
+    parser.add_argument('--profile', nargs='+', default=(), metavar='STAGE', help='dump a cProfile of these stages next to the report')
+    args = parser.parse_args()
+
+    # parameters
+    workflow_config = config.config.load_config(args.config)
+    paths = workflow_config.paths
+    stages = build_stages(workflow_config)
+    report = args.report or paths.get('workflow_report')
+
+    if args.list:
+        for stage in stages:
+            print(stage.name)
+    else:
+        workflow_config.check_paths()
+
+        runner = fct.workflow.Runner(
+            stages,
+            state_path = paths.get('workflow_state') or 'workflow_state.json',
+            jobs = workflow_config.params['jobs'],
+            profile = args.profile,
+            profile_dir = os.path.dirname(os.path.abspath(report or paths.get('workflow_state') or 'workflow_state.json')))
+
+        try:
+            runner.run(only=args.only, start=args.start, force=args.force)
+        finally:
+            if report:
+                fct.report.write_report(report)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+-------------------------------------------------------------------------------
+"This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+-------------------------------------------------------------------------------
+
+Regression tests of compute_strahler_orders against the previous StrahlerOrder
+implementation, which walked downstream from each head line.
+"""
+
+import random
+import fiona
+import fiona.crs
+import pytest
+from fct.vector_tools import compute_strahler_orders, StrahlerOrder
+
+
+def reference_strahler_orders(lines):
+    """
+    Strahler orders of the previous StrahlerOrder implementation, kept as a
+    reference: walk downstream from each head line, searching the next and
+    the sibling lines in the whole network at each step.
+    """
+    # function to find head line in network (top upstream)
+    def find_head_lines(lines):
+        head_idx = []
+
+        num_lines = len(lines)
+        for i in range(num_lines):
+            first_point = lines[i][0]
+
+            has_upstream = False
+
+            for j in range(num_lines):
+                if j == i:
+                    continue
+                last_point = lines[j][-1]
+
+                if first_point == last_point:
+                    has_upstream = True
+
+            if not has_upstream:
+                head_idx.append(i)
+
+        return head_idx
+
+    # function to find next line downstream
+    def find_next_line(curr_idx, lines):
+        last_point = lines[curr_idx][-1]
+
+        for i in range(len(lines)):
+            if i == curr_idx:
+                continue
+            if last_point == lines[i][0]:
+                return i
+
+        return None
+
+    # function to find sibling line (confluence line)
+    def find_sibling_line(curr_idx, lines):
+        last_point = lines[curr_idx][-1]
+
+        for i in range(len(lines)):
+            if i == curr_idx:
+                continue
+            if last_point == lines[i][-1]:
+                return i
+
+        return None
+
+    orders = [0] * len(lines)
+
+    for idx in find_head_lines(lines):
+        curr_idx = idx
+        curr_ord = 1
+        # head lines order = 1
+        orders[curr_idx] = curr_ord
+        # go downstream from each head lines
+        while True:
+            next_idx = find_next_line(curr_idx, lines)
+            if next_idx is None:
+                break
+            next_ord = orders[next_idx]
+            sibl_idx = find_sibling_line(curr_idx, lines)
+            # if confluence
+            if sibl_idx is not None:
+                sibl_ord = orders[sibl_idx]
+                # check if confluence, and if same strahler order add +1 to order
+                if sibl_ord > curr_ord:
+                    break
+                elif sibl_ord < curr_ord:
+                    if next_ord == curr_ord:
+                        break
+                else:
+                    curr_ord += 1
+            orders[next_idx] = curr_ord
+            curr_idx = next_idx
+
+    return orders
+
+
+def random_dendritic_network(count, seed):
+    """
+    Random binary tree of `count` lines flowing to a single outlet, as
+    (first_point, last_point) tuples, in a shuffled order.
+    """
+    rng = random.Random(seed)
+    nodes = 1
+    lines = []
+    frontier = [0]
+
+    while len(lines) < count:
+        downstream = frontier.pop(rng.randrange(len(frontier)))
+        for _ in range(2 if len(lines) + 2 <= count else 1):
+            lines.append((nodes, downstream))
+            frontier.append(nodes)
+            nodes += 1
+
+    rng.shuffle(lines)
+
+    return [((node_a, 0.0), (node_b, 0.0)) for node_a, node_b in lines]
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_random_dendritic_networks(seed):
+    lines = random_dendritic_network(random.Random(seed).randint(1, 60), seed)
+
+    assert compute_strahler_orders(lines) == reference_strahler_orders(lines)
+
+
+def test_confluence_of_three_tributaries():
+    # three order 1 heads and an order 2 branch joining at the same point
+    lines = [
+        ((1, 0), (0, 0)),
+        ((2, 0), (0, 0)),
+        ((3, 0), (0, 0)),
+        ((0, 0), (-1, 0)),
+    ]
+    assert compute_strahler_orders(lines) == reference_strahler_orders(lines) == [1, 1, 1, 2]
+
+    lines = [
+        ((10, 0), (5, 0)),
+        ((11, 0), (5, 0)),
+        ((5, 0), (0, 0)),
+        ((1, 0), (0, 0)),
+        ((2, 0), (0, 0)),
+        ((0, 0), (-1, 0)),
+    ]
+    assert compute_strahler_orders(lines) == reference_strahler_orders(lines) == [1, 1, 2, 1, 1, 2]
+
+
+def test_cycle_lines_get_order_zero():
+    # a tree and a loop without head line: the loop lines can not be reached
+    lines = [
+        ((1, 0), (0, 0)),
+        ((2, 0), (0, 0)),
+        ((0, 0), (-1, 0)),
+        ((10, 0), (11, 0)),
+        ((11, 0), (12, 0)),
+        ((12, 0), (10, 0)),
+    ]
+    assert compute_strahler_orders(lines) == reference_strahler_orders(lines) == [1, 1, 2, 0, 0, 0]
+
+    # a head line flowing into a loop: the previous walk went around the loop,
+    # the loop lines now wait for their upstream lines forever and get order 0
+    lines = [
+        ((0, 0), (1, 0)),
+        ((1, 0), (2, 0)),
+        ((2, 0), (3, 0)),
+        ((3, 0), (1, 0)),
+    ]
+    assert compute_strahler_orders(lines) == [1, 0, 0, 0]
+
+
+def test_strahler_order_drops_cycle_lines(tmp_path):
+    network = str(tmp_path / 'network.gpkg')
+    output = str(tmp_path / 'strahler.gpkg')
+    lines = [
+        [(1, 0), (0, 0)],
+        [(2, 0), (0, 0)],
+        [(0, 0), (-1, 0)],
+        [(10, 0), (11, 0)],
+        [(11, 0), (12, 0)],
+        [(12, 0), (10, 0)],
+    ]
+    schema = {'geometry': 'LineString', 'properties': {'ID': 'int'}}
+
+    with fiona.open(network, 'w', driver='GPKG', crs=fiona.crs.CRS.from_epsg(2154), schema=schema) as dst:
+        dst.writerecords(
+            {'geometry': {'type': 'LineString', 'coordinates': line}, 'properties': {'ID': i}}
+            for i, line in enumerate(lines))
+
+    StrahlerOrder(network, output)
+
+    with fiona.open(output) as src:
+        orders = {feature['properties']['ID']: feature['properties']['strahler'] for feature in src}
+
+    assert orders == {0: 1, 1: 1, 2: 2}